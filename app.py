@@ -1,13 +1,15 @@
 from collections import namedtuple
-import base64
 import datetime
+import hashlib
 import json
 import logging
 import math
 import os
+import time
 
 from flask import abort
 from flask import Flask
+from flask import make_response
 from flask import redirect
 from flask import render_template
 from flask import request
@@ -22,13 +24,16 @@ from flask.ext.script import Manager
 from flask.ext.sqlalchemy import SQLAlchemy
 from wtforms import ValidationError
 import humanize
-import simplecrypt
 import wtforms as wtf
 
 from service import utils
 from service.auth import Auth
 from service.cascade import Cascade
+from service.crypto import Crypto
 from service.exchange import Exchange
+from service.jobs import JobQueue
+from service.scheduler import Scheduler
+from service.server import Server
 
 
 ##################################################
@@ -59,6 +64,45 @@ for disabled_logger in ('pyexchange', ):
 app = Flask(__name__)
 app.debug = True
 app.config['SECRET_KEY'] = 'This is the secret key for Outcade.'
+# How many users to sync with Cascade at once
+app.config['CASCADE_SYNC_WORKERS'] = int(os.environ.get('CASCADE_SYNC_WORKERS', 4))
+# How many chunks of each users Cascade planner to fetch at once
+app.config['CASCADE_FETCH_WORKERS'] = int(os.environ.get('CASCADE_FETCH_WORKERS', 1))
+# Months of the Cascade planner to sync & how often, as months:seconds pairs
+# e.g. 2:0,4:21600 syncs this & next month every run & the 4 after that every 6 hours
+app.config['CASCADE_SYNC_TIERS'] = [
+    tuple(int(part) for part in tier.split(':'))
+    for tier in os.environ.get('CASCADE_SYNC_TIERS', '2:0,4:21600').split(',')
+]
+# How to parse Cascade planner pages (stream or pyquery)
+app.config['CASCADE_PARSER'] = os.environ.get('CASCADE_PARSER', 'stream')
+# How many users to push to Exchange at once
+app.config['EXCHANGE_SYNC_WORKERS'] = int(os.environ.get('EXCHANGE_SYNC_WORKERS', 4))
+# How many events to send to Exchange in each request
+app.config['EXCHANGE_BATCH_SIZE'] = int(os.environ.get('EXCHANGE_BATCH_SIZE', 50))
+# How often the worker syncs each user with Cascade & Exchange (seconds)
+app.config['CASCADE_SYNC_INTERVAL'] = int(os.environ.get('CASCADE_SYNC_INTERVAL', 900))
+app.config['EXCHANGE_SYNC_INTERVAL'] = int(os.environ.get('EXCHANGE_SYNC_INTERVAL', 900))
+# Push runs of all day events to Exchange as one item per block of days (0 or 1)
+app.config['EXCHANGE_COALESCE'] = bool(int(os.environ.get('EXCHANGE_COALESCE', 0)))
+# How many web server processes to run in production & how many threads in each
+app.config['WEB_CONCURRENCY'] = int(os.environ.get('WEB_CONCURRENCY', 2))
+app.config['WEB_THREADS'] = int(os.environ.get('WEB_THREADS', 4))
+# How long a web process can go quiet before it's restarted (seconds)
+app.config['WEB_TIMEOUT'] = int(os.environ.get('WEB_TIMEOUT', 120))
+# DB connections each web process keeps open (default one per thread) & extra ones it can open
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 0))
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW', 2))
+# How long each process remembers who a logged in user is (seconds)
+app.config['AUTH_USER_TTL'] = int(os.environ.get('AUTH_USER_TTL', 30))
+# How long a checked Exchange login is trusted without asking Exchange again (seconds)
+app.config['LOGIN_CACHE_TTL'] = int(os.environ.get('LOGIN_CACHE_TTL', 15 * 60))
+# How many users calendars to keep built in each process
+app.config['CALENDAR_CACHE_SIZE'] = int(os.environ.get('CALENDAR_CACHE_SIZE', 256))
+# Longest the worker waits before retrying a user whose sync errored (seconds)
+app.config['SYNC_MAX_BACKOFF'] = int(os.environ.get('SYNC_MAX_BACKOFF', 6 * 60 * 60))
+# How long a sync can hold a user before another process may take over (seconds)
+app.config['SYNC_LEASE_TTL'] = int(os.environ.get('SYNC_LEASE_TTL', 30 * 60))
 heroku = Heroku(app)
 
 
@@ -73,20 +117,15 @@ class Models(object):
     pass
 db.models = Models()
 
+# Derive the encryption keys once per process, not on every call
+crypto = Crypto(app.config['SECRET_KEY'])
+
 def encrypt(dec):
-    enc = simplecrypt.encrypt(
-        app.config['SECRET_KEY'],
-        dec,
-    )
-    return base64.b64encode(enc)
+    return crypto.encrypt(dec)
 
 
 def decrypt(enc):
-    dec = simplecrypt.decrypt(
-        app.config['SECRET_KEY'],
-        base64.b64decode(enc),
-    )
-    return dec.decode('utf8')
+    return crypto.decrypt(enc)
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -97,10 +136,18 @@ class User(db.Model):
     exchange_password_encrypted = db.Column(db.String(200), nullable=False)
     exchange_last_sync_time = db.Column(db.DateTime())
     exchange_last_sync_status = db.Column(db.Text())
+    # Where we got to last time we looked for changes in the exchange calendar
+    exchange_sync_state_json = db.Column(db.Text())
     cascade_username = db.Column(db.String(100), nullable=False)
     cascade_password_encrypted = db.Column(db.String(200), nullable=False)
     cascade_last_sync_time = db.Column(db.DateTime())
     cascade_last_sync_status = db.Column(db.Text())
+    # When each tier of months was last synced from cascade & a hash of its events
+    cascade_sync_tiers_json = db.Column(db.Text())
+    # Bumped whenever this users events change so cached calendars are rebuilt
+    events_version = db.Column(db.Integer(), nullable=False, default=0)
+    # Cookies from the last cascade login
+    cascade_cookies_encrypted = db.Column(db.Text())
 
     def __unicode__(self):
         return '{name} ({id})'.format(
@@ -120,17 +167,52 @@ class User(db.Model):
         self.cascade_password_encrypted = encrypt(password)
     cascade_password = property(cascade_password_get, cascade_password_set)
 
+    def cascade_cookies_get(self):
+        if self.cascade_cookies_encrypted is None:
+            return None
+        return json.loads(decrypt(self.cascade_cookies_encrypted))
+    def cascade_cookies_set(self, cookies):
+        if cookies is None:
+            self.cascade_cookies_encrypted = None
+        else:
+            self.cascade_cookies_encrypted = encrypt(json.dumps(cookies))
+    cascade_cookies = property(cascade_cookies_get, cascade_cookies_set)
+
+    def cascade_sync_tiers_get(self):
+        if self.cascade_sync_tiers_json is None:
+            return None
+        return json.loads(self.cascade_sync_tiers_json)
+    def cascade_sync_tiers_set(self, tiers):
+        if tiers is None:
+            self.cascade_sync_tiers_json = None
+        else:
+            self.cascade_sync_tiers_json = json.dumps(tiers)
+    cascade_sync_tiers = property(cascade_sync_tiers_get, cascade_sync_tiers_set)
+
+    def exchange_sync_state_get(self):
+        if self.exchange_sync_state_json is None:
+            return None
+        return json.loads(self.exchange_sync_state_json)
+    def exchange_sync_state_set(self, state):
+        if state is None:
+            self.exchange_sync_state_json = None
+        else:
+            self.exchange_sync_state_json = json.dumps(state)
+    exchange_sync_state = property(exchange_sync_state_get, exchange_sync_state_set)
+
     @property
     def cascade_last_sync_error(self):
         if self.cascade_last_sync_status is None:
             return None
-        return ('error' in self.cascade_last_sync_status)
+        # Check the key; failure messages can mention errors too
+        return ('error' in json.loads(self.cascade_last_sync_status))
 
     @property
     def exchange_last_sync_error(self):
         if self.exchange_last_sync_status is None:
             return None
-        return ('error' in self.exchange_last_sync_status)
+        # Check the key; failure messages can mention errors too
+        return ('error' in json.loads(self.exchange_last_sync_status))
 
     @property
     def cascade_last_sync_diff(self):
@@ -232,11 +314,33 @@ class Event(db.Model):
 
     # This is how we find the event in outlook (they're really long)
     exchange_id = db.Column(db.String(200))
+    # Or the item for the block of days it was coalesced into
+    exchange_item_id = db.Column(
+        db.Integer,
+        db.ForeignKey('exchange_item.id', onupdate="CASCADE", ondelete="SET NULL"),
+    )
+    exchange_item = db.relationship('ExchangeItem', backref='events')
 
     # These keep track of whether we need to push updates into exchange
     last_update = db.Column(db.DateTime())
     last_push = db.Column(db.DateTime())
 
+    # Deleted events are never removed so these need to skip over them
+    __table_args__ = (
+        db.Index('ix_event_user_id_day', 'user_id', 'day'),
+        db.Index(
+            'ix_event_user_id_day_live',
+            'user_id', 'day', 'period', 'event_type',
+            postgresql_where=db.text('NOT deleted'),
+        ),
+        db.Index(
+            'ix_event_user_id_updated',
+            'user_id',
+            postgresql_where=db.text('updated'),
+        ),
+        db.Index('ix_event_exchange_item_id', 'exchange_item_id'),
+    )
+
     def __unicode__(self):
         output = '{date} : {period}'.format(
             date=self.day.strftime('%d/%m/%Y'),
@@ -274,6 +378,79 @@ class Event(db.Model):
 
 db.models.Event = Event
 
+# A single Exchange item covering a block of consecutive all day events
+class ExchangeItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+    )
+    user = db.relationship('User', backref='exchange_items')
+    exchange_id = db.Column(db.String(200), nullable=False)
+    event_type = db.Column(db.String(10), nullable=False) #BANK, REQUESTED, APPROVED
+    first_day = db.Column(db.Date(), nullable=False)
+    last_day = db.Column(db.Date(), nullable=False)
+    last_push = db.Column(db.DateTime())
+
+    __table_args__ = (
+        db.Index('ix_exchange_item_user_id', 'user_id'),
+    )
+
+    def __unicode__(self):
+        return '{first} - {last} ({type})'.format(
+            first=self.first_day.strftime('%d/%m/%Y'),
+            last=self.last_day.strftime('%d/%m/%Y'),
+            type=self.event_type,
+        )
+
+db.models.ExchangeItem = ExchangeItem
+
+class SyncJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+    )
+    user = db.relationship('User', backref='sync_jobs')
+    direction = db.Column(db.String(10), nullable=False) #cascade, exchange
+    status = db.Column(db.String(10), nullable=False, default='queued') #queued, running, done, failed
+    due = db.Column(db.DateTime(), nullable=False, default=datetime.datetime.now)
+    started = db.Column(db.DateTime())
+    finished = db.Column(db.DateTime())
+    result = db.Column(db.Text())
+
+    __table_args__ = (
+        # Jobs waiting to be claimed, in the order they'll be claimed
+        db.Index(
+            'ix_sync_job_due_queued',
+            'due',
+            postgresql_where=db.text("status = 'queued'"),
+        ),
+        # Only one outstanding job per user & direction
+        db.Index(
+            'ix_sync_job_user_id_direction_outstanding',
+            'user_id', 'direction',
+            unique=True,
+            postgresql_where=db.text("status IN ('queued', 'running')"),
+        ),
+    )
+
+db.models.SyncJob = SyncJob
+
+class SyncLease(db.Model):
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('user.id', onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    direction = db.Column(db.String(10), primary_key=True) #cascade, exchange
+    token = db.Column(db.String(32), nullable=False)
+    expires = db.Column(db.DateTime(), nullable=False)
+
+db.models.SyncLease = SyncLease
+
 
 ##################################################
 #                    Services
@@ -282,10 +459,43 @@ db.models.Event = Event
 exchange = Exchange(
     db,
     'https://outlook.artsalliancemedia.com/EWS/Exchange.asmx',
-    'aam'
+    'aam',
+    workers=app.config['EXCHANGE_SYNC_WORKERS'],
+    batch_size=app.config['EXCHANGE_BATCH_SIZE'],
+    coalesce=app.config['EXCHANGE_COALESCE'],
+    lease_ttl=app.config['SYNC_LEASE_TTL'],
+    # Keep connections until after the next sync (plus jitter) so it reuses them
+    service_ttl=2 * app.config['EXCHANGE_SYNC_INTERVAL'],
+)
+cascade = Cascade(
+    db,
+    'arts',
+    workers=app.config['CASCADE_SYNC_WORKERS'],
+    parser=app.config['CASCADE_PARSER'],
+    fetch_workers=app.config['CASCADE_FETCH_WORKERS'],
+    sync_tiers=app.config['CASCADE_SYNC_TIERS'],
+    lease_ttl=app.config['SYNC_LEASE_TTL'],
+    # Keep sessions until after the next sync (plus jitter) so it reuses them
+    session_idle_timeout=2 * app.config['CASCADE_SYNC_INTERVAL'],
+)
+auth = Auth(
+    db,
+    exchange,
+    user_ttl=app.config['AUTH_USER_TTL'],
+    login_ttl=app.config['LOGIN_CACHE_TTL'],
+)
+# Built calendars keyed on user, their events version & the date
+calendar_cache = utils.Cache(
+    max_size=app.config['CALENDAR_CACHE_SIZE'],
+    ttl=24 * 60 * 60,
+)
+job_queue = JobQueue(
+    db,
+    {
+        'cascade': cascade,
+        'exchange': exchange,
+    },
 )
-cascade = Cascade(db, 'arts')
-auth = Auth(db, exchange)
 
 ##################################################
 #                    Setup admin
@@ -418,6 +628,33 @@ class EventView(AuthenticateModelView):
     )
     column_default_sort = 'day'
 
+    def _bump_events_version(self, user_ids):
+        # Make sure the users calendars get rebuilt; done in SQL so we can't
+        # lose a bump from a sync at the same time
+        user_ids = [user_id for user_id in user_ids if user_id is not None]
+        if not user_ids:
+            return
+        db.session.query(
+            User
+        ).filter(
+            User.id.in_(user_ids)
+        ).update({
+            'events_version': User.events_version + 1,
+        }, synchronize_session=False)
+
+    def on_model_change(self, form, model, is_created):
+        # user_id isn't updated until we flush so it's still the old user if
+        # the event has been moved to someone else
+        self._bump_events_version(set([
+            model.user_id,
+            model.user.id if model.user is not None else None,
+        ]))
+        return super(EventView, self).on_model_change(form, model, is_created)
+
+    def on_model_delete(self, model):
+        self._bump_events_version([model.user_id])
+        return super(EventView, self).on_model_delete(model)
+
 
 admin = Admin(app)
 admin.add_view(UserAdminView(User, db.session))
@@ -455,9 +692,68 @@ def logout():
     auth.logout()
     return redirect(url_for('splash'))
 
+def outcade_validators(user):
+    """
+    Get the ETag, Last-Modified (in UTC) & events version for the given users
+    outcade page
+    It only changes when they sync, their events or details change or the hour
+    changes (so how long ago they synced is never more than an hour out)
+    """
+    # Read together so the validators match the calendar we build
+    events_version, last_update = db.session.query(
+        User.events_version,
+        db.func.max(Event.last_update),
+    ).outerjoin(
+        Event,
+        Event.user_id == User.id,
+    ).filter(
+        User.id == user.id
+    ).group_by(
+        User.events_version
+    ).one()
+
+    hour = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    changes = [
+        hour,
+        user.cascade_last_sync_time,
+        user.exchange_last_sync_time,
+        last_update,
+    ]
+    last_modified = max(change for change in changes if change is not None)
+
+    etag = hashlib.sha1(json.dumps([
+        user.id,
+        user.name,
+        user.is_admin,
+        user.sync_enabled,
+        user.cascade_username,
+        user.sync_status_summary,
+        events_version,
+        [str(change) for change in changes],
+    ])).hexdigest()
+
+    last_modified = datetime.datetime.utcfromtimestamp(time.mktime(last_modified.timetuple()))
+    return etag, last_modified, events_version
+
 @app.route('/outcade/', methods=['GET', 'POST'])
 @auth.authorised
 def outcade():
+    if request.method == 'GET':
+        # Don't bother building the page if the browser already has it
+        etag, last_modified, events_version = outcade_validators(request.user)
+        if request.headers.get('If-None-Match'):
+            # NOTE: werkzeug's is_resource_modified ignores weak ETags
+            not_modified = request.if_none_match.contains_weak(etag)
+        else:
+            not_modified = (
+                request.if_modified_since is not None
+                and last_modified.replace(microsecond=0) <= request.if_modified_since
+            )
+        if not_modified:
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+
     form = user_single_view.edit_form(request.user)
     updated = False
     if request.method == 'POST':
@@ -469,24 +765,38 @@ def outcade():
             # Update the model
             updated = user_single_view.update_model(form, request.user)
 
-    # Get a calendar
+        events_version = request.user.events_version
+
+    # Get a calendar (only rebuilt when the users events or the date change)
     now = datetime.date.today()
-    event_calendar = utils.generate_calendar(
-        db,
-        request.user,
-        now.year,
-        now.month,
-        6,
+    event_calendar = calendar_cache.get_or_create(
+        (request.user.id, events_version, now),
+        lambda: utils.generate_calendar(
+            db,
+            request.user,
+            now.year,
+            now.month,
+            6,
+        ),
     )
 
-    return render_template(
+    response = make_response(render_template(
         'outcade.html',
         updated=updated,
         form=form,
         event_calendar=event_calendar,
         # Needed for flask-admin form render
         h=h,
-    )
+    ))
+
+    if request.method == 'GET':
+        # Let the browser check back with us rather than always re-fetching
+        response.set_etag(etag, weak=True)
+        response.last_modified = last_modified
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+    return response
 
 @app.route('/sync_cascade/', methods=['GET', 'POST'])
 @auth.authorised
@@ -512,53 +822,214 @@ def sync_exchange():
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
-@manager.command
-def production():
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Number of server processes (default WEB_CONCURRENCY)')
+@manager.option('-t', '--threads', dest='threads', type=int, default=None,
+                help='Number of threads in each server process (default WEB_THREADS)')
+def production(workers, threads):
     """
     Run the server in production mode
     """
+    if workers is None:
+        workers = app.config['WEB_CONCURRENCY']
+    if threads is None:
+        threads = app.config['WEB_THREADS']
+
     # Turn off debug on live...
     app.debug = False
 
+    # Give every thread in each process its own DB connection
+    # NOTE: This has to be done before anything connects to the DB
+    app.config['SQLALCHEMY_POOL_SIZE'] = app.config['DB_POOL_SIZE'] or threads
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = app.config['DB_MAX_OVERFLOW']
+
     # Upgrade the DB
     from flask.ext.migrate import upgrade
     upgrade()
 
     # Bind to PORT if defined, otherwise default to 5000.
     port = int(os.environ.get('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
-
-@manager.command
-def sync_cascade():
+    Server(app, {
+        'bind': '0.0.0.0:{port}'.format(port=port),
+        'workers': workers,
+        'threads': threads,
+        'timeout': app.config['WEB_TIMEOUT'],
+        # Load everything once then fork so workers share the memory
+        'preload_app': True,
+        # Connections made before forking can't be shared with the workers
+        'post_fork': lambda server, worker: db.engine.dispose(),
+    }).run()
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Number of users to sync at once (default CASCADE_SYNC_WORKERS)')
+def sync_cascade(workers):
     """
     Sync events from cascade
     """
     logger.info('Syncing cascade...')
-    result = cascade.sync()
+    result = cascade.sync(workers=workers)
     logger.info('Syncing cascade done!')
     logger.info(json.dumps(result, indent=4))
 
-@manager.command
-def sync_exchange():
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Number of users to sync at once (default EXCHANGE_SYNC_WORKERS)')
+def sync_exchange(workers):
     """
     Sync events to exchange
     """
     logger.info('Syncing exchange...')
-    result = exchange.sync()
+    result = exchange.sync(workers=workers)
     logger.info('Syncing exchange done!')
     logger.info(json.dumps(result, indent=4))
 
-@manager.command
-def sync():
+@manager.option('-c', '--cascade-workers', dest='cascade_workers', type=int, default=None,
+                help='Number of users to sync with cascade at once (default CASCADE_SYNC_WORKERS)')
+@manager.option('-e', '--exchange-workers', dest='exchange_workers', type=int, default=None,
+                help='Number of users to sync with exchange at once (default EXCHANGE_SYNC_WORKERS)')
+def sync(cascade_workers, exchange_workers):
     """
     Sync everything
     """
     logger.info('Syncing cascade...')
-    result = cascade.sync()
+    result = cascade.sync(workers=cascade_workers)
     logger.info('Syncing exchange...')
-    result = exchange.sync()
+    result = exchange.sync(workers=exchange_workers)
     logger.info('Syncing done!')
 
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Number of users to sync at once (default CASCADE_SYNC_WORKERS)')
+def worker(workers):
+    """
+    Keep syncing users with cascade & exchange as they become due
+    """
+    if workers is None:
+        workers = app.config['CASCADE_SYNC_WORKERS']
+    cascade.set_workers(workers)
+    scheduler = Scheduler(
+        db,
+        {
+            'cascade': cascade,
+            'exchange': exchange,
+        },
+        {
+            'cascade': app.config['CASCADE_SYNC_INTERVAL'],
+            'exchange': app.config['EXCHANGE_SYNC_INTERVAL'],
+        },
+        workers=workers,
+        max_backoff=app.config['SYNC_MAX_BACKOFF'],
+    )
+    logger.info('Starting sync worker...')
+    scheduler.run()
+
+@manager.option('direction', choices=('cascade', 'exchange'),
+                help='Which sync to queue')
+def enqueue_syncs(direction):
+    """
+    Queue a sync for every enabled user, to be run by job_worker
+    """
+    count = job_queue.enqueue(direction)
+    logger.info('Queued {count} {direction} syncs'.format(
+        count=count,
+        direction=direction,
+    ))
+
+@manager.option('-w', '--workers', dest='workers', type=int, default=None,
+                help='Number of jobs to run at once (default CASCADE_SYNC_WORKERS)')
+def job_worker(workers):
+    """
+    Keep running queued sync jobs (as many job_workers as you like can run at once)
+    """
+    if workers is None:
+        workers = app.config['CASCADE_SYNC_WORKERS']
+    cascade.set_workers(workers)
+    logger.info('Starting job worker...')
+    job_queue.work(workers=workers)
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=100,
+                help='Number of users to re-encrypt per transaction')
+def reencrypt(batch_size):
+    """
+    Re-encrypt any credentials still in the old (slow) format, a batch at a time
+    Safe to run while the app is up; values which change meanwhile are left alone
+    """
+    columns = (
+        'exchange_password_encrypted',
+        'cascade_password_encrypted',
+        'cascade_cookies_encrypted',
+    )
+    last_id = 0
+    count = 0
+    while True:
+        rows = db.session.query(
+            User.id,
+            *[getattr(User, column) for column in columns]
+        ).filter(
+            User.id > last_id
+        ).order_by(
+            User.id
+        ).limit(batch_size).all()
+        if not rows:
+            break
+
+        for row in rows:
+            for column in columns:
+                enc = getattr(row, column)
+                if enc is None or not crypto.is_legacy(enc):
+                    continue
+                # Only replace the value we read in case it's been changed since
+                count += db.session.query(
+                    User
+                ).filter(
+                    User.id == row.id,
+                    getattr(User, column) == enc,
+                ).update({
+                    column: crypto.encrypt(crypto.decrypt(enc)),
+                }, synchronize_session=False)
+
+        db.session.commit()
+        last_id = rows[-1].id
+        logger.info('Re-encrypted {count} values (up to user {last_id})'.format(
+            count=count,
+            last_id=last_id,
+        ))
+
+@manager.option('-u', '--users', dest='users', type=int, default=400,
+                help='Number of users to seed events for')
+@manager.option('-y', '--years', dest='years', type=int, default=5,
+                help='Number of years of history to seed')
+@manager.option('-r', '--repeats', dest='repeats', type=int, default=200,
+                help='Number of times to run each query')
+def benchmark_event_indexes(users, years, repeats):
+    """
+    Time the event queries against a large temporary table, with & without indexes
+    """
+    from service import benchmark
+    result = benchmark.event_indexes(db, users, years, repeats)
+    logger.info(json.dumps(result, indent=4))
+
+@manager.option('path', help='Saved planner.asp page to parse')
+@manager.option('-r', '--repeats', dest='repeats', type=int, default=50,
+                help='Number of times to parse the page with each parser')
+def benchmark_parsers(path, repeats):
+    """
+    Check the Cascade planner parsers agree on a saved page & time them
+    """
+    from service import benchmark
+    with open(path) as calendar_file:
+        calendar_html = calendar_file.read().decode('utf8')
+    result = benchmark.parsers(cascade, calendar_html, repeats)
+    logger.info(json.dumps(result, indent=4))
+
+@manager.option('-r', '--repeats', dest='repeats', type=int, default=20,
+                help='Number of times to encrypt & decrypt with each format')
+def benchmark_credentials(repeats):
+    """
+    Time encrypting & decrypting credentials in the old & new formats
+    """
+    from service import benchmark
+    result = benchmark.credentials(crypto, repeats)
+    logger.info(json.dumps(result, indent=4))
+
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,46 @@
+"""Add exchange_item & Event.exchange_item_id
+
+Revision ID: 0f6e2a9c4b53
+Revises: 5e0a3c6b9d27
+Create Date: 2026-10-18 15:21:37.258000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0f6e2a9c4b53'
+down_revision = '5e0a3c6b9d27'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('exchange_item',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('exchange_id', sa.String(length=200), nullable=False),
+        sa.Column('event_type', sa.String(length=10), nullable=False),
+        sa.Column('first_day', sa.Date(), nullable=False),
+        sa.Column('last_day', sa.Date(), nullable=False),
+        sa.Column('last_push', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_exchange_item_user_id', 'exchange_item', ['user_id'])
+    op.add_column('event', sa.Column('exchange_item_id', sa.Integer(), nullable=True))
+    op.create_foreign_key(
+        'event_exchange_item_id_fkey',
+        'event', 'exchange_item',
+        ['exchange_item_id'], ['id'],
+        onupdate='CASCADE',
+        ondelete='SET NULL',
+    )
+    op.create_index('ix_event_exchange_item_id', 'event', ['exchange_item_id'])
+
+
+def downgrade():
+    op.drop_index('ix_event_exchange_item_id', 'event')
+    op.drop_constraint('event_exchange_item_id_fkey', 'event')
+    op.drop_column('event', 'exchange_item_id')
+    op.drop_index('ix_exchange_item_user_id', 'exchange_item')
+    op.drop_table('exchange_item')
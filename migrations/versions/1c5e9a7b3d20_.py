@@ -0,0 +1,46 @@
+"""Add indexes for the event queries
+
+Revision ID: 1c5e9a7b3d20
+Revises: 4fd58f290323
+Create Date: 2026-10-18 10:12:41.503000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1c5e9a7b3d20'
+down_revision = '4fd58f290323'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Any event for a user in a date range (also covers the user FK)
+    op.create_index(
+        'ix_event_user_id_day',
+        'event',
+        ['user_id', 'day'],
+    )
+
+    # Live events for a user in a date range (Cascade sync & calendar)
+    # Deleted events are never removed so most of the table is skipped
+    op.create_index(
+        'ix_event_user_id_day_live',
+        'event',
+        ['user_id', 'day', 'period', 'event_type'],
+        postgresql_where=sa.text('NOT deleted'),
+    )
+
+    # Events waiting to be pushed to Exchange
+    op.create_index(
+        'ix_event_user_id_updated',
+        'event',
+        ['user_id'],
+        postgresql_where=sa.text('updated'),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_event_user_id_updated', 'event')
+    op.drop_index('ix_event_user_id_day_live', 'event')
+    op.drop_index('ix_event_user_id_day', 'event')
@@ -0,0 +1,29 @@
+"""Add sync_lease
+
+Revision ID: 2c8d5a7f1e39
+Revises: 6d2b8f0e4a71
+Create Date: 2026-10-18 13:52:44.109000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2c8d5a7f1e39'
+down_revision = '6d2b8f0e4a71'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('sync_lease',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('direction', sa.String(length=10), nullable=False),
+        sa.Column('token', sa.String(length=32), nullable=False),
+        sa.Column('expires', sa.DateTime(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('user_id', 'direction')
+    )
+
+
+def downgrade():
+    op.drop_table('sync_lease')
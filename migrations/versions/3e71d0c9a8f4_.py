@@ -0,0 +1,22 @@
+"""Add User.cascade_cookies_encrypted
+
+Revision ID: 3e71d0c9a8f4
+Revises: 5b8e2f61c4a9
+Create Date: 2026-10-18 11:47:52.910000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3e71d0c9a8f4'
+down_revision = '5b8e2f61c4a9'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('cascade_cookies_encrypted', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'cascade_cookies_encrypted')
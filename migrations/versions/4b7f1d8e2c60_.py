@@ -0,0 +1,22 @@
+"""Add User.events_version
+
+Revision ID: 4b7f1d8e2c60
+Revises: 0f6e2a9c4b53
+Create Date: 2026-10-18 16:05:12.843000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4b7f1d8e2c60'
+down_revision = '0f6e2a9c4b53'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('events_version', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    op.drop_column('user', 'events_version')
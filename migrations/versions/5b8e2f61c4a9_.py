@@ -0,0 +1,22 @@
+"""Add User.cascade_sync_fingerprint
+
+Revision ID: 5b8e2f61c4a9
+Revises: 1c5e9a7b3d20
+Create Date: 2026-10-18 11:02:17.284000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e2f61c4a9'
+down_revision = '1c5e9a7b3d20'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('cascade_sync_fingerprint', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'cascade_sync_fingerprint')
@@ -0,0 +1,22 @@
+"""Add User.exchange_sync_state_json
+
+Revision ID: 5e0a3c6b9d27
+Revises: 2c8d5a7f1e39
+Create Date: 2026-10-18 14:38:03.776000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e0a3c6b9d27'
+down_revision = '2c8d5a7f1e39'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('exchange_sync_state_json', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('user', 'exchange_sync_state_json')
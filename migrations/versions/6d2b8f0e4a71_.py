@@ -0,0 +1,52 @@
+"""Add sync_job
+
+Revision ID: 6d2b8f0e4a71
+Revises: 7a4c9e2d5b18
+Create Date: 2026-10-18 13:14:28.652000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6d2b8f0e4a71'
+down_revision = '7a4c9e2d5b18'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('sync_job',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('direction', sa.String(length=10), nullable=False),
+        sa.Column('status', sa.String(length=10), nullable=False),
+        sa.Column('due', sa.DateTime(), nullable=False),
+        sa.Column('started', sa.DateTime(), nullable=True),
+        sa.Column('finished', sa.DateTime(), nullable=True),
+        sa.Column('result', sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], onupdate='CASCADE', ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    # Jobs waiting to be claimed, in the order they'll be claimed
+    op.create_index(
+        'ix_sync_job_due_queued',
+        'sync_job',
+        ['due'],
+        postgresql_where=sa.text("status = 'queued'"),
+    )
+
+    # Only one outstanding job per user & direction
+    op.create_index(
+        'ix_sync_job_user_id_direction_outstanding',
+        'sync_job',
+        ['user_id', 'direction'],
+        unique=True,
+        postgresql_where=sa.text("status IN ('queued', 'running')"),
+    )
+
+
+def downgrade():
+    op.drop_index('ix_sync_job_user_id_direction_outstanding', 'sync_job')
+    op.drop_index('ix_sync_job_due_queued', 'sync_job')
+    op.drop_table('sync_job')
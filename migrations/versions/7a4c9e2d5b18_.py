@@ -0,0 +1,24 @@
+"""Replace User.cascade_sync_fingerprint with per tier sync state
+
+Revision ID: 7a4c9e2d5b18
+Revises: 3e71d0c9a8f4
+Create Date: 2026-10-18 12:31:06.417000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7a4c9e2d5b18'
+down_revision = '3e71d0c9a8f4'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('user', sa.Column('cascade_sync_tiers_json', sa.Text(), nullable=True))
+    op.drop_column('user', 'cascade_sync_fingerprint')
+
+
+def downgrade():
+    op.add_column('user', sa.Column('cascade_sync_fingerprint', sa.String(length=64), nullable=True))
+    op.drop_column('user', 'cascade_sync_tiers_json')
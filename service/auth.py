@@ -1,22 +1,79 @@
 import functools
 
+from flask import g
 from flask import redirect
 from flask import request
 from flask import session
 from flask import url_for
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
 from sqlalchemy.orm.exc import NoResultFound
 
+from service import utils
+
 class Auth(object):
-    def __init__(self, db, exchange):
+    def __init__(self, db, exchange, user_ttl=30, login_ttl=15 * 60, cache_size=256):
         self.db = db
         self.exchange = exchange
 
+        # Recently checked logins; keyed on a salted hash of the username &
+        # password, holding the users encrypted password when we checked
+        # NOTE: A password changed in Exchange keeps working for up to login_ttl
+        self.logins = utils.Cache(max_size=cache_size, ttl=login_ttl)
+
+        # Column values of recently seen users, keyed on id
+        # NOTE: Changes made by other processes take up to user_ttl to show up
+        self.users = utils.Cache(max_size=cache_size, ttl=user_ttl)
+        event.listen(db.models.User, 'after_update', self._forget_user)
+        event.listen(db.models.User, 'after_delete', self._forget_user)
+
+    def _forget_user(self, mapper, connection, user):
+        """
+        Drop the given user from the cache when they're changed or deleted
+        """
+        self.users.delete(user.id)
+
+    def _load_user(self, user_id):
+        """
+        Get the user with the given id in the current DB session (or None)
+        Only goes to the DB if they aren't cached
+        """
+        User = self.db.models.User
+        columns = self.users.get(user_id)
+        if columns is None:
+            try:
+                user = self.db.session.query(
+                    User
+                ).filter(
+                    User.id == user_id
+                ).one()
+            except NoResultFound, ex:
+                return None
+
+            # events_version is bumped in bulk (without telling us) so it's
+            # left out; it's loaded fresh from the DB when it's needed
+            self.users.set(user_id, dict(
+                (prop.key, getattr(user, prop.key))
+                for prop in User.__mapper__.column_attrs
+                if prop.key != 'events_version'
+            ))
+            return user
+
+        # Rebuild the user & attach them to the session without a query
+        user = User(**columns)
+        make_transient_to_detached(user)
+        return self.db.session.merge(user, load=False)
+
     def login(self, exchange, username, password):
         """
         Login the given user
         """
-        if not exchange.test_login(username, password):
-            return False
+        # Only ask Exchange if we haven't checked these details recently
+        key = utils.credential_key(None, username, password)
+        checked = self.logins.get(key)
+        if checked is None:
+            if not exchange.test_login(username, password):
+                return False
 
         # User is valid, find/create them in the DB
         try:
@@ -28,7 +85,10 @@ class Auth(object):
             ).one()
 
             # Update existing users password to the one they're using now
-            user.exchange_password = password
+            # (if it's still what we saved last time, we know it hasn't changed)
+            if checked != user.exchange_password_encrypted and user.exchange_password != password:
+                user.exchange_password = password
+                self.db.session.commit()
         except NoResultFound, ex:
             # Create a new user
             user = self.db.models.User(
@@ -40,9 +100,9 @@ class Auth(object):
                 cascade_password=password,
             )
             self.db.session.add(user)
+            self.db.session.commit()
 
-        # We've either added a new user or updated their password, save now
-        self.db.session.commit()
+        self.logins.set(key, user.exchange_password_encrypted)
 
         # Setup the session
         session.permanent = True
@@ -59,21 +119,23 @@ class Auth(object):
 
     def get_current_user(self):
         # Check there is a user in the session
-        if session.get('user_id', None) is None:
+        user_id = session.get('user_id', None)
+        if user_id is None:
             return None
 
+        # Only look the user up once per request
+        current = getattr(g, 'current_user', None)
+        if current is not None and current[0] == user_id:
+            return current[1]
+
         # Check the user is still valid
-        try:
-            user = self.db.session.query(
-                self.db.models.User
-            ).filter(
-                self.db.models.User.id == session['user_id']
-            ).one()
-        except NoResultFound, ex:
+        user = self._load_user(user_id)
+        if user is None:
             # User no longer exists in the database, they need to login again
             return None
 
         # Everything pass
+        g.current_user = (user_id, user)
         return user
 
     def authorised(self, func):
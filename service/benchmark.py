@@ -0,0 +1,194 @@
+import datetime
+import logging
+import random
+import time
+
+from sqlalchemy import text
+
+
+# Indexes from migration 1c5e9a7b3d20, applied to the benchmark table
+EVENT_INDEXES = (
+    'CREATE INDEX ON bench_event (user_id, day)',
+    'CREATE INDEX ON bench_event (user_id, day, period, event_type) WHERE NOT deleted',
+    'CREATE INDEX ON bench_event (user_id) WHERE updated',
+)
+
+# The hot queries against event, pointed at the benchmark table
+EVENT_QUERIES = (
+    ('Cascade._update_events', """
+        SELECT id, day, period, event_type, last_update
+        FROM bench_event
+        WHERE user_id = :user_id
+        AND day >= :start AND day < :end
+        AND NOT deleted
+    """),
+    ('Exchange._get_user_updated_events', """
+        SELECT *
+        FROM bench_event
+        WHERE user_id = :user_id
+        AND updated
+    """),
+    ('utils.generate_calendar', """
+        SELECT *
+        FROM bench_event
+        WHERE user_id = :user_id
+        AND NOT deleted
+        AND day >= :start AND day < :end
+    """),
+)
+
+
+def _time_queries(connection, users, repeats):
+    """
+    Run each of the event queries #repeats times for random users
+    Return the query plan & average time in ms for each query
+    """
+    today = datetime.date.today()
+    results = {}
+    for name, sql in EVENT_QUERIES:
+        params = {
+            'user_id': 1,
+            'start': today,
+            'end': today + datetime.timedelta(days=183),
+        }
+        plan = '\n'.join(
+            row[0]
+            for row in connection.execute(text('EXPLAIN ' + sql), **params)
+        )
+
+        start = time.time()
+        for x in xrange(repeats):
+            params['user_id'] = random.randint(1, users)
+            connection.execute(text(sql), **params).fetchall()
+        diff = time.time() - start
+
+        results[name] = {
+            'plan': plan.strip(),
+            'ms': round(diff * 1000.0 / repeats, 3),
+        }
+    return results
+
+
+def event_indexes(db, users, years, repeats):
+    """
+    Seed a temporary copy of event with #years of history for #users users
+    (mostly deleted, as on live) and time the hot queries against it without
+    and then with the event indexes
+    NOTE: Postgres only; nothing is written to the real event table
+    """
+    connection = db.engine.connect()
+    try:
+        # Not INCLUDING DEFAULTS; that would use up ids from event's sequence
+        connection.execute('CREATE TEMP TABLE bench_event (LIKE event)')
+
+        # Every weekday for every user, most of them long since deleted
+        logging.info('Seeding bench_event...')
+        connection.execute(text("""
+            INSERT INTO bench_event (id, user_id, day, period, event_type, updated, deleted)
+            SELECT
+                row_number() OVER (),
+                users.id,
+                days.day::date,
+                'AFD',
+                'APPROVED',
+                random() < 0.01,
+                random() < 0.9
+            FROM
+                generate_series(1, :users) AS users(id),
+                generate_series(
+                    CURRENT_DATE - (:years * interval '1 year'),
+                    CURRENT_DATE + interval '1 year',
+                    interval '1 day'
+                ) AS days(day)
+            WHERE extract(dow from days.day) BETWEEN 1 AND 5
+        """), users=users, years=years)
+        connection.execute('ANALYZE bench_event')
+        rows = connection.execute('SELECT count(*) FROM bench_event').scalar()
+
+        logging.info('Timing queries without indexes...')
+        before = _time_queries(connection, users, repeats)
+
+        for sql in EVENT_INDEXES:
+            connection.execute(sql)
+        connection.execute('ANALYZE bench_event')
+
+        logging.info('Timing queries with indexes...')
+        after = _time_queries(connection, users, repeats)
+    finally:
+        connection.execute('DROP TABLE IF EXISTS bench_event')
+        connection.close()
+
+    return {
+        'rows': rows,
+        'before': before,
+        'after': after,
+    }
+
+
+def parsers(cascade, calendar_html, repeats):
+    """
+    Check the Cascade planner parsers agree on the given page & time them
+    """
+    results = {}
+    events = {}
+    for parser in cascade.PARSERS:
+        start = time.time()
+        for x in xrange(repeats):
+            events[parser] = cascade._parse_calendar_html(calendar_html, parser=parser)
+        diff = time.time() - start
+
+        results[parser] = {
+            'events': len(events[parser]),
+            'ms': round(diff * 1000.0 / repeats, 3),
+        }
+
+    # Every parser must give exactly the same events
+    first = events[cascade.PARSERS[0]]
+    for parser in cascade.PARSERS[1:]:
+        if events[parser] != first:
+            raise Exception('Parser {parser} disagrees with {first}!'.format(
+                parser=parser,
+                first=cascade.PARSERS[0],
+            ))
+
+    return results
+
+
+def credentials(crypto, repeats):
+    """
+    Time encrypting & decrypting a password in the old & new formats
+    A sync decrypts up to 3 values per user (both passwords & the cascade cookies)
+    """
+    password = u'correct horse battery staple'
+    formats = (
+        ('legacy', crypto.encrypt_legacy, crypto.decrypt_legacy),
+        ('current', crypto.encrypt, crypto.decrypt),
+    )
+    results = {}
+    for name, encrypt, decrypt in formats:
+        start = time.time()
+        for x in xrange(repeats):
+            enc = encrypt(password)
+        encrypt_diff = time.time() - start
+
+        start = time.time()
+        for x in xrange(repeats):
+            dec = decrypt(enc)
+        decrypt_diff = time.time() - start
+
+        if dec != password:
+            raise Exception('Format {name} did not round trip!'.format(
+                name=name,
+            ))
+
+        results[name] = {
+            'encrypt_ms': round(encrypt_diff * 1000.0 / repeats, 3),
+            'decrypt_ms': round(decrypt_diff * 1000.0 / repeats, 3),
+            'user_sync_ms': round(decrypt_diff * 3000.0 / repeats, 3),
+        }
+
+    results['user_sync_saving_ms'] = round(
+        results['legacy']['user_sync_ms'] - results['current']['user_sync_ms'],
+        3,
+    )
+    return results
@@ -1,32 +1,271 @@
 # https://www.cascadehrponline.net/planner.asp?planneropts=3&startyear=2014&startmonth=8
+from collections import deque
 from urlparse import urljoin
 import datetime
+import hashlib
 import json
 import logging
+import math
+import threading
 import time
 
+from lxml import etree
 import requests
 from pyquery import PyQuery as pq
-from sqlalchemy.orm.exc import NoResultFound
 
 from service import utils
+from service.leases import Leases
+from service.session_pool import SessionPool
+
+
+class SessionExpired(Exception):
+    pass
+
+
+class ChunkSizer(object):
+    """
+    Picks how many months to fetch in each planner request, assuming each
+    request takes overhead + per_month * months seconds & fitting those two
+    from the timings of recent requests
+    """
+    def __init__(self, samples=50):
+        self.samples = deque(maxlen=samples)
+        self.lock = threading.Lock()
+
+    def record(self, months, seconds):
+        """
+        Record that fetching #months took #seconds
+        """
+        with self.lock:
+            self.samples.append((months, seconds))
+
+    def _fit(self):
+        """
+        Least squares fit of (overhead, per_month) to the recorded timings
+        Return None if we can't tell the two apart yet
+        """
+        with self.lock:
+            samples = list(self.samples)
+
+        count = len(samples)
+        if count < 2:
+            return None
+        mean_months = sum(months for months, seconds in samples) / float(count)
+        mean_seconds = sum(seconds for months, seconds in samples) / float(count)
+        variance = sum((months - mean_months) ** 2 for months, seconds in samples)
+        if variance == 0:
+            # Every request was the same size
+            return None
+
+        per_month = sum(
+            (months - mean_months) * (seconds - mean_seconds)
+            for months, seconds in samples
+        ) / variance
+        overhead = mean_seconds - per_month * mean_months
+        return max(overhead, 0.0), max(per_month, 0.0)
+
+    def chunk_months(self, months, concurrency):
+        """
+        Get how many months to fetch per request for a window of #months when
+        we can make #concurrency requests at once
+        """
+        fit = self._fit()
+        if fit is None:
+            # Spread the window over a single round of requests
+            return int(math.ceil(months / float(concurrency)))
+        overhead, per_month = fit
+
+        def wall_time(chunk):
+            fetches = int(math.ceil(months / float(chunk)))
+            rounds = int(math.ceil(fetches / float(concurrency)))
+            return rounds * (overhead + per_month * chunk)
+
+        # Biggest chunks first so ties go to fewer requests
+        return min(xrange(months, 0, -1), key=wall_time)
+
+
+class PlannerCellTarget(object):
+    """
+    lxml parser target which collects the attributes of the cells matching
+    '#planner_content table tr td[cd]' without building a tree
+    Each open element records how far through that selector it & its
+    ancestors get: 1 = planner_content, 2 = table, 3 = tr
+    """
+    def __init__(self):
+        self.stack = [0]
+        self.cells = []
+
+    def start(self, tag, attrib):
+        matched = self.stack[-1]
+        if matched == 3:
+            # We're inside a row, is this a date cell?
+            if tag == 'td' and 'cd' in attrib:
+                self.cells.append((attrib['cd'], attrib.get('onmouseover')))
+        elif matched == 2:
+            if tag == 'tr':
+                matched = 3
+        elif matched == 1:
+            if tag == 'table':
+                matched = 2
+        elif attrib.get('id') == 'planner_content':
+            matched = 1
+        self.stack.append(matched)
+
+    def end(self, tag):
+        self.stack.pop()
+
+    def close(self):
+        return self.cells
 
 
 class Cascade(object):
     base_url = 'https://www.cascadehrponline.net/'
+    PARSERS = ('stream', 'pyquery')
+
+    def __init__(self, db, company, workers=1, parser='stream', fetch_workers=1,
+                 sync_tiers=((6, 0), ), lease_ttl=30 * 60, session_idle_timeout=300,
+                 session_check_after=60, cache_size=512):
+        # Validate what's passed in
+        if parser not in self.PARSERS:
+            raise Exception('Cascade parser must be one of {parsers}'.format(
+                parsers=', '.join(self.PARSERS),
+            ))
 
-    def __init__(self, db, company):
         # Save everything for later
         self.db = db
         self.company = company
+        self.workers = workers
+        self.parser = parser
+        self.fetch_workers = fetch_workers
+        # (months, max_age in seconds) for each tier, nearest months first
+        self.sync_tiers = sync_tiers
+        self.leases = Leases(db, 'cascade', ttl=lease_ttl)
+        self.chunk_sizer = ChunkSizer()
+        # Logged in sessions, sharing one connection per request we make at once
+        self.sessions = SessionPool(
+            self.base_url,
+            connections=workers * fetch_workers,
+            idle_timeout=session_idle_timeout,
+            check_after=session_check_after,
+            max_size=cache_size,
+        )
+
+    def set_workers(self, workers):
+        """
+        Change how many users are synced at once by default, making sure
+        there are enough pooled connections for them
+        """
+        self.workers = workers
+        self.sessions.ensure_connections(workers * self.fetch_workers)
+
+    def _session_key(self, user):
+        """
+        Get the key for the given user's session in self.sessions
+        """
+        return utils.credential_key(
+            user.id,
+            user.cascade_username,
+            user.cascade_password_encrypted,
+        )
 
-    @utils.memo(max_age=60)
     def _get_session(self, user):
+        """
+        Get a logged in Cascade session for the given user
+        Sessions are pooled for a while & their cookies are saved on the user
+        so we don't have to login every time
+        """
+        return self.sessions.get(
+            self._session_key(user),
+            lambda: self._load_session(user) or self._login(user),
+            self._check_session,
+        )
+
+    def _check_session(self, session):
+        """
+        Check the given session is still logged in to Cascade
+        """
+        check_url = urljoin(
+            self.base_url,
+            'planner.asp'
+        )
+        try:
+            check_response = session.head(
+                check_url,
+                allow_redirects=False,
+            )
+        except requests.RequestException:
+            return False
+
+        # Logged out sessions get sent back to the login page
+        return check_response.status_code == 200
+
+    def _forget_session(self, user):
+        """
+        Forget the given user's session (e.g. because Cascade rejected it)
+        """
+        self.sessions.discard(self._session_key(user))
+        user.cascade_cookies = None
+        self.db.session.commit()
+
+    def _cookies_fingerprint(self, user):
+        """
+        Get a hash of the credentials saved cookies are valid for
+        """
+        return hashlib.sha256(u'\0'.join([
+            user.cascade_username,
+            user.cascade_password_encrypted,
+        ]).encode('utf8')).hexdigest()
+
+    def _save_session(self, user, session):
+        """
+        Save the cookies from the given session on the user
+        """
+        user.cascade_cookies = {
+            'credentials': self._cookies_fingerprint(user),
+            'cookies': [
+                {
+                    'name': cookie.name,
+                    'value': cookie.value,
+                    'domain': cookie.domain,
+                    'path': cookie.path,
+                }
+                for cookie in session.cookies
+            ],
+        }
+        self.db.session.commit()
+
+    def _load_session(self, user):
+        """
+        Make a session from the cookies saved on the user
+        Return None if there are no usable cookies
+        """
+        try:
+            saved = user.cascade_cookies
+        except Exception, ex:
+            # Probably encrypted with an old key, we'll just login again
+            logging.warning('Unable to load Cascade cookies: {ex}'.format(ex=ex))
+            return None
+
+        if saved is None or saved['credentials'] != self._cookies_fingerprint(user):
+            # Credentials have changed since these were saved
+            return None
+
+        session = self.sessions.new_session()
+        for cookie in saved['cookies']:
+            session.cookies.set(
+                cookie['name'],
+                cookie['value'],
+                domain=cookie['domain'],
+                path=cookie['path'],
+            )
+        return session
+
+    def _login(self, user):
         """
         Login to Cascade & setup a cookie session
         """
         # Create a new session
-        session = requests.Session()
+        session = self.sessions.new_session()
 
         # Call the login function
         logging.debug('Logging in to Cascade...')
@@ -51,12 +290,16 @@ class Cascade(object):
         if 'The username or password is incorrect.' in login_response.text:
             raise Exception('Incorrect username or password for Cascade!')
 
+        # Keep the cookies for next time
+        self._save_session(user, session)
+
         # Return the logged in session
         return session
 
     def _get_calendar_html(self, session, year, month, months=1):
         """
         Get the calendar for the user in session for the given year and month.
+        Raise SessionExpired if Cascade wants us to login again
         NOTE: month is 1 based
         """
         # https://www.cascadehrponline.net/planner.asp?startyear=2014&startmonth=0&monthstoshow=1
@@ -66,67 +309,102 @@ class Cascade(object):
         )
         calendar_response = session.get(
             calendar_url,
+            allow_redirects=False,
             params={
                 'startyear': year,
                 'startmonth': month-1,
                 'monthstoshow': months,
             }
         )
+
+        # Logged out sessions get sent back to the login page
+        if calendar_response.is_redirect or 'logon_funct.asp' in calendar_response.text:
+            raise SessionExpired('Cascade session has expired')
+
         return calendar_response.text
 
-    def _parse_calendar_html(self, calendar_html):
+    def _parse_cell(self, current_date, caption):
         """
-        Get the calendar for the user in session for the given year and month.
+        Get the event for a planner cell from its cd & onmouseover attributes
+        Return None if there is no event we care about
         """
-        events = []
+        #if(cellstart == -1) doTooltip(event, '<div>Holiday&nbspAll Day </div>');
+
+        # Check this is a day we care about
+        if caption is None or 'Holiday' not in caption:
+            return None
+
+        # Convert to a datetime (dd/mm/yyyy; much quicker than strptime)
+        day, month, year = current_date.split('/')
+        day = datetime.datetime(int(year), int(month), int(day))
+
+        # Extract the period
+        if 'AM' in caption:
+            period = 'AM'
+        elif 'PM' in caption:
+            period = 'PM'
+        else:
+            period = 'AFD'
+
+        # Extract the event_type
+        if 'Bank Holiday' in caption:
+            event_type = 'BANK'
+        elif 'Request' in caption:
+            event_type = 'REQUESTED'
+        else:
+            event_type = 'APPROVED'
+
+        return {
+            'day': day,
+            'period': period,
+            'event_type': event_type,
+        }
 
+    def _get_cells_pyquery(self, calendar_html):
+        """
+        Get the (cd, onmouseover) attributes of each planner date cell
+        Builds the whole DOM & runs a selector over it
+        """
         # Extract the cells
         dom = pq(calendar_html)
         cells = dom('#planner_content table tr td[cd]')
 
-        # Extract the date cells
-        for cell in cells:
-            # Check if this is a date cell
-            current_date = cell.attrib.get('cd')
-            if current_date is None:
-                continue
-
-            # Get all the details
-            caption = cell.attrib.get('onmouseover')
-            #if(cellstart == -1) doTooltip(event, '<div>Holiday&nbspAll Day </div>');
+        return [
+            (cell.attrib.get('cd'), cell.attrib.get('onmouseover'))
+            for cell in cells
+        ]
 
-            # Check this is a day we care about
-            if caption is None or 'Holiday' not in caption:
-                continue
+    def _get_cells_stream(self, calendar_html):
+        """
+        Get the (cd, onmouseover) attributes of each planner date cell
+        Uses the same HTML parser as pyquery but doesn't build a tree
+        """
+        parser = etree.HTMLParser(target=PlannerCellTarget())
+        parser.feed(calendar_html)
+        return parser.close()
 
-            # Convert to a datetime
-            day = datetime.datetime.strptime(
-                current_date,
-                '%d/%m/%Y',
-            )
+    def _parse_calendar_html(self, calendar_html, parser=None):
+        """
+        Get the events from the given planner page
+        """
+        if parser is None:
+            parser = self.parser
 
-            # Extract the period
-            if 'AM' in caption:
-                period = 'AM'
-            elif 'PM' in caption:
-                period = 'PM'
-            else:
-                period = 'AFD'
+        if parser == 'stream':
+            cells = self._get_cells_stream(calendar_html)
+        else:
+            cells = self._get_cells_pyquery(calendar_html)
 
-            # Extract the event_type
-            if 'Bank Holiday' in caption:
-                event_type = 'BANK'
-            elif 'Request' in caption:
-                event_type = 'REQUESTED'
-            else:
-                event_type = 'APPROVED'
+        # Extract the events from the date cells
+        events = []
+        for current_date, caption in cells:
+            # Check if this is a date cell
+            if current_date is None:
+                continue
 
-            # Add an event
-            events.append({
-                'day': day,
-                'period': period,
-                'event_type': event_type,
-            })
+            event = self._parse_cell(current_date, caption)
+            if event is not None:
+                events.append(event)
 
         return events
 
@@ -137,6 +415,7 @@ class Cascade(object):
         NOTE: month is 1 based!
         Return stats about what happened
         """
+        Event = self.db.models.Event
 
         now = datetime.datetime.now()
         results = {
@@ -145,91 +424,310 @@ class Cascade(object):
             'deleted': 0,
         }
 
+        # Work out the period we're updating
+        months_start = datetime.date(year=year, month=month, day=1)
+        year, month = utils.add_months(year, month, months)
+        months_end = datetime.date(year=year, month=month, day=1)
+
+        # Work out which events we've been given
+        event_keys = []
         for event_info in events:
-            # Find or create this event
-            try:
-                # Find an existing event
-                event = self.db.session.query(
-                    self.db.models.Event
-                ).filter(
-                    self.db.models.Event.user == user,
-                    self.db.models.Event.day == event_info['day'],
-                    self.db.models.Event.period == event_info['period'],
-                    self.db.models.Event.event_type == event_info['event_type'],
-                    self.db.models.Event.deleted == False,
-                ).one()
+            day = event_info['day']
+            if isinstance(day, datetime.datetime):
+                day = day.date()
+            event_keys.append((day, event_info['period'], event_info['event_type']))
+
+        # Load all the live events we might match in one go
+        load_start = min([months_start] + [key[0] for key in event_keys])
+        load_end = max([months_end] + [key[0] + datetime.timedelta(days=1) for key in event_keys])
+        existing_events = self.db.session.query(
+            Event.id,
+            Event.day,
+            Event.period,
+            Event.event_type,
+            Event.last_update,
+        ).filter(
+            Event.user_id == user.id,
+            Event.day >= load_start,
+            Event.day < load_end,
+            Event.deleted == False,
+        ).all()
+        existing_ids = {}
+        for existing_event in existing_events:
+            key = (existing_event.day, existing_event.period, existing_event.event_type)
+            existing_ids.setdefault(key, existing_event.id)
+
+        # Events we weren't given by day & period, in case only their type changed
+        matched_ids = set(existing_ids[key] for key in event_keys if key in existing_ids)
+        unmatched_ids = {}
+        for existing_event in existing_events:
+            if existing_event.id not in matched_ids:
+                key = (existing_event.day, existing_event.period)
+                unmatched_ids.setdefault(key, []).append(existing_event.id)
+
+        # Find, change or create each event
+        seen_ids = set()
+        new_keys = set()
+        new_rows = []
+        # event_type -> ids of events changing to it
+        retyped_ids = {}
+        for key in event_keys:
+            if key in existing_ids:
+                # Found an existing event
+                seen_ids.add(existing_ids[key])
                 results['updated'] += 1
-            except NoResultFound, ex:
+            elif key in new_keys:
+                # Given the same event twice, we're already creating it
+                results['updated'] += 1
+            elif unmatched_ids.get(key[:2]):
+                # Only the type has changed (e.g. a request was approved); change
+                # it in place so its Exchange item is updated rather than replaced
+                new_keys.add(key)
+                event_id = unmatched_ids[key[:2]].pop()
+                seen_ids.add(event_id)
+                retyped_ids.setdefault(key[2], []).append(event_id)
+                results['updated'] += 1
+            else:
+                new_keys.add(key)
                 # Create a new event
-                event = self.db.models.Event(
-                    user=user,
-                    day=event_info['day'],
-                    period=event_info['period'],
-                    event_type=event_info['event_type'],
-                    updated=True,
-                )
-                self.db.session.add(event)
+                day, period, event_type = key
+                new_rows.append({
+                    'user_id': user.id,
+                    'day': day,
+                    'period': period,
+                    'event_type': event_type,
+                    'updated': True,
+                    'deleted': False,
+                    'last_update': now,
+                })
                 results['created'] += 1
 
-            # Record that we updated/created the event
-            event.last_update = now
+        # Record that we updated/created the events
+        if seen_ids:
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.id.in_(seen_ids)
+            ).update({
+                'last_update': now,
+            }, synchronize_session=False)
+        for event_type, event_ids in retyped_ids.iteritems():
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.id.in_(event_ids)
+            ).update({
+                'event_type': event_type,
+                'updated': True,
+                'last_update': now,
+            }, synchronize_session=False)
+        if new_rows:
+            self.db.session.execute(
+                Event.__table__.insert().values(new_rows)
+            )
+
+        # Set any events in the current period that we havent updated to be deleted
+        ids_to_delete = [
+            existing_event.id
+            for existing_event in existing_events
+            if existing_event.id not in seen_ids
+            and months_start <= existing_event.day < months_end
+            and existing_event.last_update is not None
+            and existing_event.last_update < now
+        ]
+        results['deleted'] = len(ids_to_delete)
+        if ids_to_delete:
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.id.in_(ids_to_delete)
+            ).update({
+                'updated': True,
+                'deleted': True,
+            }, synchronize_session=False)
+
+        # Let anything cached from the old events know they're out of date
+        if new_rows or retyped_ids or ids_to_delete:
+            User = self.db.models.User
+            self.db.session.query(
+                User
+            ).filter(
+                User.id == user.id
+            ).update({
+                'events_version': User.events_version + 1,
+            }, synchronize_session=False)
 
-        # Have to commit now or the last_update changes don't take effect!
         self.db.session.commit()
 
-        # Set any events in the current period that we havent updated to be deleted
-        months_start = datetime.date(year=year, month=month, day=1)
-        year, month = utils.add_months(year, month, months)
-        months_end = datetime.date(year=year, month=month, day=1)
+        return results
 
-        events_to_delete = self.db.session.query(
-            self.db.models.Event
-        ).filter(
-            self.db.models.Event.user == user,
-            self.db.models.Event.day >= months_start,
-            self.db.models.Event.day < months_end,
-            self.db.models.Event.deleted == False,
-            self.db.models.Event.last_update < now,
+    def _fetch_events(self, session, year, month, months):
+        """
+        Get the events for the user in session for the given year and month
+        Record how long Cascade took so we can pick good chunk sizes
+        NOTE: month is 1 based
+        """
+        start = time.time()
+        calendar_html = self._get_calendar_html(session, year, month, months)
+        self.chunk_sizer.record(months, time.time() - start)
+
+        return self._parse_calendar_html(calendar_html)
+
+    def _get_events(self, session, year, month, months):
+        """
+        Get the events for the user in session for the given year and month
+        If we have fetch_workers, the months are split into chunks which are
+        fetched at the same time
+        NOTE: month is 1 based
+        """
+        if self.fetch_workers <= 1:
+            return self._fetch_events(session, year, month, months)
+
+        # Split the months up
+        chunk_months = self.chunk_sizer.chunk_months(months, self.fetch_workers)
+        chunks = []
+        for offset in xrange(0, months, chunk_months):
+            chunk_year, chunk_month = utils.add_months(year, month, offset)
+            chunks.append((
+                chunk_year,
+                chunk_month,
+                min(chunk_months, months - offset),
+            ))
+
+        # Fetch them all
+        chunk_events = utils.parallel_map(
+            lambda chunk: self._fetch_events(session, *chunk),
+            chunks,
+            self.fetch_workers,
         )
-        results['deleted'] = events_to_delete.count()
-        events_to_delete.update({
-            'updated': True,
-            'deleted': True,
-        })
 
-        self.db.session.commit()
+        # Merge them back together (ignoring any days that appear in 2 chunks)
+        events = []
+        seen_keys = set()
+        for chunk in chunk_events:
+            chunk_keys = set()
+            for event_info in chunk:
+                key = (event_info['day'], event_info['period'], event_info['event_type'])
+                if key not in seen_keys:
+                    events.append(event_info)
+                    chunk_keys.add(key)
+            seen_keys.update(chunk_keys)
+        return events
 
-        return results
+    def _fingerprint_events(self, year, month, months, events):
+        """
+        Get a hash of the given events for the given window
+        NOTE: month is 1 based!
+        """
+        event_keys = sorted(
+            '{day:%Y-%m-%d} {period} {event_type}'.format(**event_info)
+            for event_info in events
+        )
+        fingerprint = hashlib.sha256()
+        fingerprint.update('{year}-{month}+{months}\n'.format(
+            year=year,
+            month=month,
+            months=months,
+        ))
+        fingerprint.update('\n'.join(event_keys))
+        return fingerprint.hexdigest()
+
+    def _sync_tiers(self, now):
+        """
+        Get the windows to sync for each tier, starting from the current month
+        Return a list of (key, year, month, months, max_age)
+        NOTE: month is 1 based!
+        """
+        tiers = []
+        offset = 0
+        for months, max_age in self.sync_tiers:
+            year, month = utils.add_months(now.year, now.month, offset)
+            key = '{year}-{month:02d}+{months}'.format(
+                year=year,
+                month=month,
+                months=months,
+            )
+            tiers.append((key, year, month, months, max_age))
+            offset += months
+        return tiers
 
-    def _sync_user(self, user, months=6):
+    def _fetch_user_events(self, user, year, month, months):
+        """
+        Get the events for the given user from Cascade, logging in again if
+        their saved session has expired
+        NOTE: month is 1 based!
+        """
+        cascade_session = self._get_session(user)
+        try:
+            return self._get_events(cascade_session, year, month, months)
+        except SessionExpired:
+            # Saved session is no good any more, login again & retry
+            self._forget_session(user)
+            cascade_session = self._get_session(user)
+            return self._get_events(cascade_session, year, month, months)
+
+    def _sync_user(self, user):
         """
         Sync the given user with Cascade
+        Each tier of months is only fetched once it is older than its max_age
+        & only events in the fetched tier are reconciled
         Return stats about what happened
         """
-        # Get the current year and month
         now = datetime.datetime.now()
-        year = now.year
-        month = now.month
-
-        # Get the info from cascade
-        cascade_session = self._get_session(user)
-        calendar_html = self._get_calendar_html(
-            cascade_session,
-            year,
-            month,
-            months,
-        )
-        events = self._parse_calendar_html(calendar_html)
-
-        # Save it to DB
-        result = self._update_events(
-            year,
-            month,
-            months,
-            user,
-            events,
+        tiers = self._sync_tiers(now)
+
+        # Windows move every month so old tiers just drop out
+        old_state = user.cascade_sync_tiers or {}
+        new_state = dict(
+            (key, old_state[key])
+            for key, year, month, months, max_age in tiers
+            if key in old_state
         )
 
+        result = {
+            'created': 0,
+            'updated': 0,
+            'deleted': 0,
+            'tiers': {},
+        }
+
+        for key, year, month, months, max_age in tiers:
+            tier_state = new_state.get(key)
+            if tier_state is not None and time.time() - tier_state['synced'] < max_age:
+                result['tiers'][key] = 'not due'
+                continue
+
+            # Get the info from cascade
+            events = self._fetch_user_events(user, year, month, months)
+
+            # Check if anything has changed since we last saved this tier
+            fingerprint = self._fingerprint_events(year, month, months, events)
+            if tier_state is not None and fingerprint == tier_state['fingerprint']:
+                result['tiers'][key] = 'unchanged'
+            else:
+                # Save it to DB
+                tier_result = self._update_events(
+                    year,
+                    month,
+                    months,
+                    user,
+                    events,
+                )
+                for stat in ('created', 'updated', 'deleted'):
+                    result[stat] += tier_result[stat]
+                result['tiers'][key] = 'synced'
+
+            # Only remember the tier once its events are saved
+            new_state[key] = {
+                'synced': time.time(),
+                'fingerprint': fingerprint,
+            }
+            user.cascade_sync_tiers = new_state
+            self.db.session.commit()
+
+        if 'synced' not in result['tiers'].values():
+            result['unchanged'] = True
+
         return result
 
     @utils.record_runtime
@@ -238,38 +736,93 @@ class Cascade(object):
         Sync the given user with Cascade
         Return stats about what happened
         """
+        # Make sure nobody else is syncing this user at the same time
+        lease = self.leases.acquire(user.id)
+        if lease is None:
+            return {
+                'busy': 'Already being synced elsewhere',
+            }
+
         try:
             # Try to sync the user
             result = self._sync_user(user)
         except Exception, ex:
+            # Throw away anything half done so we can carry on using the session
+            self.db.session.rollback()
             # Save the exception to the user
             result = {
                 'error': str(ex),
             }
+        finally:
+            self.leases.release(user.id, lease)
 
         return result
 
+    def record_sync_user(self, user):
+        """
+        Sync the given user with Cascade & record the status on them
+        Return the username and stats about what happened
+        """
+        # Sync the user
+        result = self.sync_user(user)
+
+        # Record status on the user (whoever is busy syncing them will do it)
+        if 'busy' in result:
+            return user.cascade_username, result
+        user.cascade_last_sync_status = json.dumps(result)
+        user.cascade_last_sync_time = datetime.datetime.now()
+        self.db.session.commit()
+
+        return user.cascade_username, result
+
+    def _sync_worker(self, user_id):
+        """
+        Sync the given user from a worker thread (or return None if they've gone)
+        db.session is scoped per thread so each worker gets its own session;
+        we have to remove it ourselves as there is no request teardown here
+        """
+        try:
+            user = self.db.session.query(
+                self.db.models.User
+            ).get(user_id)
+            if user is None:
+                # Deleted since we listed them
+                return None
+            return self.record_sync_user(user)
+        finally:
+            self.db.session.remove()
+
     @utils.record_runtime
-    def sync(self):
+    def sync(self, workers=None):
         """
-        Sync all users events with Cascade
+        Sync all users events with Cascade, using up to #workers users at once
         Return stats about what happened
         """
+        if workers is None:
+            workers = self.workers
+        self.sessions.ensure_connections(workers * self.fetch_workers)
+
         users = self.db.session.query(
             self.db.models.User
         ).filter(
             self.db.models.User.sync_enabled == True
         ).all()
-        results = {}
-        for user in users:
-            # Sync the user
-            result = self.sync_user(user)
 
-            # Record status on the user
-            user.cascade_last_sync_status = json.dumps(result)
-            user.cascade_last_sync_time = datetime.datetime.now()
-            self.db.session.commit()
+        if workers > 1:
+            # Workers load their own copy of each user in their own session
+            user_results = utils.parallel_map(
+                self._sync_worker,
+                [user.id for user in users],
+                workers,
+            )
+        else:
+            user_results = [self.record_sync_user(user) for user in users]
 
-            # Record in the full list of results too
-            results[user.cascade_username] = result
+        # Record in the full list of results
+        results = {}
+        for user_result in user_results:
+            if user_result is None:
+                continue
+            username, result = user_result
+            results[username] = result
         return results
@@ -0,0 +1,89 @@
+import base64
+import hashlib
+import hmac
+import os
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+import simplecrypt
+
+
+class Crypto(object):
+    """
+    Encrypts values (e.g. passwords) for storing in the DB
+    The secret key is stretched once when this is created rather than on every
+    call (as simplecrypt does) so decrypting on every sync is cheap
+    Values are AES-CTR encrypted then HMAC-SHA256 signed & prefixed with their
+    version; values from before this (simplecrypt) can still be decrypted
+    """
+    # Marks the current format; old values are plain base64 so never contain $
+    PREFIX = 'v2$'
+    # The secret key is unique to the app so a fixed salt is fine here
+    KEY_SALT = 'outcade'
+    KEY_ITERATIONS = 100000
+    NONCE_SIZE = 8
+    MAC_SIZE = 32
+
+    def __init__(self, secret_key):
+        if isinstance(secret_key, unicode):
+            secret_key = secret_key.encode('utf8')
+        self.secret_key = secret_key
+
+        keys = hashlib.pbkdf2_hmac(
+            'sha256',
+            secret_key,
+            self.KEY_SALT,
+            self.KEY_ITERATIONS,
+            64,
+        )
+        self.cipher_key = keys[:32]
+        self.mac_key = keys[32:]
+
+    def _cipher(self, nonce):
+        counter = Counter.new(64, prefix=nonce)
+        return AES.new(self.cipher_key, AES.MODE_CTR, counter=counter)
+
+    def _mac(self, data):
+        return hmac.new(self.mac_key, self.PREFIX + data, hashlib.sha256).digest()
+
+    def is_legacy(self, enc):
+        """
+        Check if the given value is still in the old (slow) format
+        """
+        return not enc.startswith(self.PREFIX)
+
+    def encrypt(self, dec):
+        if isinstance(dec, unicode):
+            dec = dec.encode('utf8')
+        nonce = os.urandom(self.NONCE_SIZE)
+        data = nonce + self._cipher(nonce).encrypt(dec)
+        return self.PREFIX + base64.b64encode(data + self._mac(data))
+
+    def decrypt(self, enc):
+        if self.is_legacy(enc):
+            return self.decrypt_legacy(enc)
+
+        raw = base64.b64decode(enc[len(self.PREFIX):])
+        data, mac = raw[:-self.MAC_SIZE], raw[-self.MAC_SIZE:]
+        if len(data) < self.NONCE_SIZE or not hmac.compare_digest(mac, self._mac(data)):
+            raise Exception('Encrypted value is corrupt (or SECRET_KEY has changed)')
+        nonce = data[:self.NONCE_SIZE]
+        dec = self._cipher(nonce).decrypt(data[self.NONCE_SIZE:])
+        return dec.decode('utf8')
+
+    def encrypt_legacy(self, dec):
+        """
+        Encrypt in the old format; only used to compare the two
+        """
+        enc = simplecrypt.encrypt(
+            self.secret_key,
+            dec,
+        )
+        return base64.b64encode(enc)
+
+    def decrypt_legacy(self, enc):
+        dec = simplecrypt.decrypt(
+            self.secret_key,
+            base64.b64decode(enc),
+        )
+        return dec.decode('utf8')
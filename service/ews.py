@@ -0,0 +1,207 @@
+# http://msdn.microsoft.com/en-us/library/office/bb409286(v=exchg.140).aspx
+# Raw EWS requests which pyexchange doesn't support (e.g. many items per call)
+from collections import namedtuple
+
+from lxml import etree
+from pyexchange.exceptions import FailedExchangeException
+from pyexchange.exchange2010.soap_request import EXCHANGE_DATE_FORMAT
+from pyexchange.exchange2010.soap_request import M
+from pyexchange.exchange2010.soap_request import NAMESPACES
+from pyexchange.exchange2010.soap_request import T
+from pyexchange.utils import convert_datetime_to_utc
+
+
+# One of these is returned for each item in a request, in the same order
+ResponseMessage = namedtuple('ResponseMessage', ['code', 'text', 'exchange_id'])
+
+# Ids of the items which changed since sync_state, from sync_folder_items
+FolderChanges = namedtuple('FolderChanges', ['sync_state', 'complete', 'created', 'updated', 'deleted'])
+
+# Response codes we care about
+NO_ERROR = 'NoError'
+ITEM_NOT_FOUND = 'ErrorItemNotFound'
+INVALID_SYNC_STATE = 'ErrorInvalidSyncStateData'
+
+
+class InvalidSyncState(FailedExchangeException):
+    pass
+
+
+def _format_datetime(value):
+    return convert_datetime_to_utc(value).strftime(EXCHANGE_DATE_FORMAT)
+
+
+def calendar_item(subject, html_body, location, start, end):
+    """
+    Build a CalendarItem for use in create_items or update_items
+    """
+    return T.CalendarItem(
+        T.Subject(subject),
+        T.Body(html_body, BodyType='HTML'),
+        T.ReminderIsSet('false'),
+        T.Start(_format_datetime(start)),
+        T.End(_format_datetime(end)),
+        T.Location(location),
+    )
+
+
+def create_items(items):
+    """
+    Build a request to create all the given CalendarItems in the calendar
+    """
+    return M.CreateItem(
+        M.SavedItemFolderId(
+            T.DistinguishedFolderId(Id='calendar')
+        ),
+        M.Items(*items),
+        SendMeetingInvitations='SendToNone',
+    )
+
+
+def update_items(changes):
+    """
+    Build a request to overwrite the subject, body & times of the given items
+    changes is a list of (exchange_id, CalendarItem from calendar_item)
+    """
+    # Fields we change & the URI Exchange knows them by
+    fields = (
+        ('Subject', 'item:Subject'),
+        ('Body', 'item:Body'),
+        ('Start', 'calendar:Start'),
+        ('End', 'calendar:End'),
+    )
+
+    item_changes = []
+    for exchange_id, item in changes:
+        updates = []
+        for name, field_uri in fields:
+            value = item.find('t:' + name, namespaces=NAMESPACES)
+            updates.append(T.SetItemField(
+                T.FieldURI(FieldURI=field_uri),
+                T.CalendarItem(value),
+            ))
+        item_changes.append(T.ItemChange(
+            T.ItemId(Id=exchange_id),
+            T.Updates(*updates),
+        ))
+
+    return M.UpdateItem(
+        M.ItemChanges(*item_changes),
+        ConflictResolution='AlwaysOverwrite',
+        SendMeetingInvitationsOrCancellations='SendToNone',
+    )
+
+
+def delete_items(exchange_ids):
+    """
+    Build a request to delete all the given items (permanently, as pyexchange does)
+    """
+    return M.DeleteItem(
+        M.ItemIds(*[
+            T.ItemId(Id=exchange_id)
+            for exchange_id in exchange_ids
+        ]),
+        DeleteType='HardDelete',
+        SendMeetingCancellations='SendToNone',
+        AffectedTaskOccurrences='AllOccurrences',
+    )
+
+
+def _send_request(service, request):
+    """
+    Send the given request using the connection from service
+    Return the parsed response
+    """
+    request_xml = service._wrap_soap_xml_request(request)
+    response = service._send_soap_request(request_xml)
+
+    try:
+        tree = etree.XML(response.encode('utf-8'))
+    except (etree.XMLSyntaxError, TypeError), ex:
+        raise FailedExchangeException(
+            u'Unable to parse response from Exchange: {ex}'.format(ex=ex)
+        )
+
+    # Faults mean the whole request failed
+    service._check_for_SOAP_fault(tree)
+
+    return tree
+
+
+def send(service, request):
+    """
+    Send the given request using the connection from service
+    Return a ResponseMessage for each item in the request
+    NOTE: Unlike service.send, this doesn't raise if individual items fail
+    """
+    tree = _send_request(service, request)
+
+    messages = []
+    for node in tree.xpath('//m:ResponseMessages/*', namespaces=NAMESPACES):
+        code = node.findtext('m:ResponseCode', namespaces=NAMESPACES)
+        text = node.findtext('m:MessageText', namespaces=NAMESPACES)
+        item_ids = node.xpath('m:Items/*/t:ItemId', namespaces=NAMESPACES)
+        if item_ids:
+            exchange_id = item_ids[0].get('Id')
+        else:
+            exchange_id = None
+        messages.append(ResponseMessage(code, text, exchange_id))
+
+    if len(messages) == 0:
+        raise FailedExchangeException(
+            u'Exchange server did not return any response messages'
+        )
+
+    return messages
+
+
+def sync_folder_items(service, sync_state=None, max_changes=512):
+    """
+    Get the ids of calendar items which changed since sync_state (or every
+    item if sync_state is None), up to max_changes at a time
+    Return FolderChanges; if it isn't complete, call again with its sync_state
+    """
+    request = M.SyncFolderItems(
+        M.ItemShape(
+            T.BaseShape('IdOnly')
+        ),
+        M.SyncFolderId(
+            T.DistinguishedFolderId(Id='calendar')
+        ),
+    )
+    if sync_state is not None:
+        request.append(M.SyncState(sync_state))
+    request.append(M.MaxChangesReturned(str(max_changes)))
+
+    tree = _send_request(service, request)
+
+    nodes = tree.xpath('//m:SyncFolderItemsResponseMessage', namespaces=NAMESPACES)
+    if len(nodes) == 0:
+        raise FailedExchangeException(
+            u'Exchange server did not return any response messages'
+        )
+    node = nodes[0]
+    code = node.findtext('m:ResponseCode', namespaces=NAMESPACES)
+    if code == INVALID_SYNC_STATE:
+        raise InvalidSyncState(u'Exchange no longer recognises our sync state')
+    if code != NO_ERROR:
+        raise FailedExchangeException(u'{code} {text}'.format(
+            code=code,
+            text=node.findtext('m:MessageText', namespaces=NAMESPACES) or u'',
+        ))
+
+    def change_ids(change):
+        return set(
+            item_id.get('Id')
+            for item_id in node.xpath('m:Changes/t:{change}//t:ItemId'.format(
+                change=change,
+            ), namespaces=NAMESPACES)
+        )
+
+    return FolderChanges(
+        sync_state=node.findtext('m:SyncState', namespaces=NAMESPACES),
+        complete=node.findtext('m:IncludesLastItemInRange', namespaces=NAMESPACES) == 'true',
+        created=change_ids('Create'),
+        updated=change_ids('Update'),
+        deleted=change_ids('Delete'),
+    )
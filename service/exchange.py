@@ -2,14 +2,18 @@
 # https://pyexchange.readthedocs.org/en/latest/
 import json
 import datetime
+import time
 
-from memoize import Memoizer
 from pyexchange import Exchange2010Service
 from pyexchange import ExchangeNTLMAuthConnection
-from pyexchange.exceptions import FailedExchangeException, ExchangeItemNotFoundException
+from pyexchange.exceptions import FailedExchangeException
+from sqlalchemy import and_
+from sqlalchemy import func
 from sqlalchemy import or_
 
+from service import ews
 from service import utils
+from service.leases import Leases
 
 
 HTML_BODY = u"""<html>
@@ -19,9 +23,89 @@ HTML_BODY = u"""<html>
     </body>
 </html>"""
 
+# All day events of these types are pushed as one item per block of days
+COALESCE_TYPES = ('APPROVED', 'BANK', 'REQUESTED')
+# Furthest apart two days in the same block can be (Friday to Monday)
+BLOCK_GAP = datetime.timedelta(days=3)
+
+
+def _consecutive(day, next_day):
+    """
+    Check whether there are only weekends between day & next_day
+    """
+    day += datetime.timedelta(days=1)
+    while day < next_day:
+        if day.weekday() < 5:
+            return False
+        day += datetime.timedelta(days=1)
+    return True
+
+
+def _weekdays(first_day, last_day):
+    """
+    Count the weekdays from first_day to last_day (inclusive)
+    """
+    count = 0
+    day = first_day
+    while day <= last_day:
+        if day.weekday() < 5:
+            count += 1
+        day += datetime.timedelta(days=1)
+    return count
+
+
+def _merge_spans(spans):
+    """
+    Merge (first day, last day) spans which overlap or are close enough for
+    their events to join into one block
+    """
+    merged = []
+    for first_day, last_day in sorted(spans):
+        if merged and first_day - merged[-1][1] <= BLOCK_GAP:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], last_day))
+        else:
+            merged.append((first_day, last_day))
+    return merged
+
+
+class Block(object):
+    """
+    A run of consecutive all day events of the same type which is pushed to
+    Exchange as a single item
+    """
+    def __init__(self, event_type, events):
+        self.event_type = event_type
+        self.events = events
+        # The item we'll update to cover this block (None to create one)
+        self.item = None
+
+    @property
+    def first_day(self):
+        return self.events[0].day
+
+    @property
+    def last_day(self):
+        return self.events[-1].day
+
+    @property
+    def start(self):
+        return self.events[0].start
+
+    @property
+    def end(self):
+        return self.events[-1].end
+
+    def __unicode__(self):
+        return u'{first} - {last} ({type})'.format(
+            first=self.first_day.strftime('%d/%m/%Y'),
+            last=self.last_day.strftime('%d/%m/%Y'),
+            type=self.event_type,
+        )
+
 
 class Exchange(object):
-    def __init__(self, db, asmx_url, domain):
+    def __init__(self, db, asmx_url, domain, workers=1, batch_size=50, coalesce=False,
+                 lease_ttl=30 * 60, service_ttl=300, cache_size=512):
         # Validate what's passed in
         if asmx_url[-5:] != '.asmx':
             possible_url = '{0}/EWS/Exchange.asmx'.format(asmx_url)
@@ -35,9 +119,13 @@ class Exchange(object):
         self.db = db
         self.asmx_url = asmx_url
         self.domain = domain
+        self.workers = workers
+        self.batch_size = batch_size
+        self.coalesce = coalesce
+        self.leases = Leases(db, 'exchange', ttl=lease_ttl)
+        self.services = utils.Cache(max_size=cache_size, ttl=service_ttl)
 
-    @utils.memo(max_age=300)
-    def _get_service(self, username, password):
+    def _build_service(self, username, password):
         """
         Get the calendar for the given connection
         """
@@ -54,6 +142,35 @@ class Exchange(object):
 
         return service
 
+    def _get_service(self, username, password):
+        """
+        Get a (cached) service for the given username & password
+        """
+        key = utils.credential_key(
+            None,
+            username,
+            password,
+        )
+        return self.services.get_or_create(
+            key,
+            lambda: self._build_service(username, password),
+        )
+
+    def _get_user_service(self, user):
+        """
+        Get a (cached) service for the given user
+        Keyed on the encrypted password so it's only decrypted when we connect
+        """
+        key = utils.credential_key(
+            user.id,
+            user.exchange_username,
+            user.exchange_password_encrypted,
+        )
+        return self.services.get_or_create(
+            key,
+            lambda: self._build_service(user.exchange_username, user.exchange_password),
+        )
+
     def test_login(self, username, password):
         """
         Check that the given username and password can login to self.asmx_url
@@ -79,97 +196,649 @@ class Exchange(object):
 
         return events
 
-    def _create_event(self, event, calendar):
+    def _get_folder_changes(self, user, service):
         """
-        Create the given event from Outlook
+        Get everything which changed in the user's calendar since we last looked
+        Return the new sync state, whether this was the first look & the ids
+        created, updated & deleted
         """
-        exchange_event = calendar.new_event(
+        saved = user.exchange_sync_state or {}
+        sync_state = saved.get('state')
+        first = sync_state is None
+        created = set()
+        updated = set()
+        deleted = set()
+        while True:
+            try:
+                changes = ews.sync_folder_items(service, sync_state)
+            except ews.InvalidSyncState:
+                if sync_state is None:
+                    raise
+                # Exchange has forgotten us, start again from scratch
+                sync_state = None
+                first = True
+                created, updated, deleted = set(), set(), set()
+                continue
+
+            created |= changes.created
+            updated |= changes.updated
+            deleted |= changes.deleted
+            if changes.complete:
+                return changes.sync_state, first, created, updated, deleted
+            sync_state = changes.sync_state
+
+    def _repair_drift(self, user, service, result):
+        """
+        Find events whose Exchange items were deleted or edited by someone
+        other than us since the last sync & get them pushed again
+        On the first look, any of our items which aren't there count as deleted
+        """
+        Event = self.db.models.Event
+        ExchangeItem = self.db.models.ExchangeItem
+        polled = time.time()
+        sync_state, first, created, updated, deleted = self._get_folder_changes(user, service)
+
+        last_polled = (user.exchange_sync_state or {}).get('polled')
+        if last_polled is not None:
+            last_polled = datetime.datetime.fromtimestamp(last_polled)
+
+        def find_drift(pushed):
+            missing_ids = []
+            changed_ids = []
+            for row in pushed:
+                if (first and row.exchange_id not in created) or row.exchange_id in deleted:
+                    missing_ids.append(row.id)
+                elif row.exchange_id in updated:
+                    # Ignore our own pushes since we last looked
+                    if last_polled is None or row.last_push is None or row.last_push < last_polled:
+                        changed_ids.append(row.id)
+            return missing_ids, changed_ids
+
+        missing_ids, changed_ids = find_drift(self.db.session.query(
+            Event.id,
+            Event.exchange_id,
+            Event.last_push,
+        ).filter(
+            Event.user_id == user.id,
+            Event.deleted == False,
+            Event.exchange_id != None,
+        ))
+        missing_item_ids, changed_item_ids = find_drift(self.db.session.query(
+            ExchangeItem.id,
+            ExchangeItem.exchange_id,
+            ExchangeItem.last_push,
+        ).filter(
+            ExchangeItem.user_id == user.id,
+        ))
+
+        # Forget the old item so the event gets created again
+        if missing_ids:
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.id.in_(missing_ids)
+            ).update({
+                'exchange_id': None,
+                'updated': True,
+            }, synchronize_session=False)
+
+        # Push our version over the top of whatever they changed
+        if changed_ids:
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.id.in_(changed_ids)
+            ).update({
+                'updated': True,
+            }, synchronize_session=False)
+
+        # Blocks are pushed again whenever their events are updated
+        if missing_item_ids or changed_item_ids:
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.exchange_item_id.in_(missing_item_ids + changed_item_ids),
+                Event.deleted == False,
+            ).update({
+                'updated': True,
+            }, synchronize_session=False)
+        if missing_item_ids:
+            self.db.session.query(
+                Event
+            ).filter(
+                Event.exchange_item_id.in_(missing_item_ids)
+            ).update({
+                'exchange_item_id': None,
+            }, synchronize_session=False)
+            self.db.session.query(
+                ExchangeItem
+            ).filter(
+                ExchangeItem.id.in_(missing_item_ids)
+            ).delete(synchronize_session=False)
+
+        result['repaired'] = len(missing_ids) + len(missing_item_ids)
+        result['drifted'] = len(changed_ids) + len(changed_item_ids)
+
+        user.exchange_sync_state = {
+            'state': sync_state,
+            'polled': polled,
+        }
+        self.db.session.commit()
+
+    def _calendar_item(self, event):
+        """
+        Build the Exchange calendar item for the given event
+        """
+        return ews.calendar_item(
             subject=u'Holiday ({type})'.format(
                 type=event.event_type
             ),
-            attendees=[],
-            location=u'Holiday',
-            start=event.start,
-            end=event.end,
             html_body=HTML_BODY.format(
                 type=event.event_type
             ),
+            location=u'Holiday',
+            start=event.start,
+            end=event.end,
         )
 
-        # Connect to Exchange and create the event
-        exchange_event.create()
+    def _send_batch(self, service, request, events):
+        """
+        Send a request for the given events to Exchange
+        Return a ResponseMessage for each event
+        """
+        messages = ews.send(service, request)
+        if len(messages) != len(events):
+            raise Exception(
+                'Sent {events} events to Exchange but got {messages} responses!'.format(
+                    events=len(events),
+                    messages=len(messages),
+                )
+            )
+        return zip(events, messages)
+
+    def _create_events(self, events, service):
+        """
+        Create the given events in Outlook with a single request
+        Return the events which failed & why
+        """
+        request = ews.create_items([
+            self._calendar_item(event)
+            for event in events
+        ])
 
-        # Save the id to the DB
-        event.exchange_id = exchange_event.id
+        failed = []
+        for event, message in self._send_batch(service, request, events):
+            if message.code == ews.NO_ERROR:
+                # Save the id to the DB
+                event.exchange_id = message.exchange_id
+                self._mark_pushed(event)
+            else:
+                failed.append((event, message))
+        return failed
 
-    def _update_event(self, event, calendar):
+    def _update_events(self, events, service):
         """
-        Update the given event from Outlook
+        Update the given events in Outlook (in place) with a single request
+        Return the events which failed & why
         """
-        raise Exception('I dont know how to update events yet!')
+        request = ews.update_items([
+            (event.exchange_id, self._calendar_item(event))
+            for event in events
+        ])
+
+        failed = []
+        for event, message in self._send_batch(service, request, events):
+            if message.code == ews.NO_ERROR:
+                self._mark_pushed(event)
+            else:
+                if message.code == ews.ITEM_NOT_FOUND:
+                    # Someone deleted it, create it again next time
+                    event.exchange_id = None
+                failed.append((event, message))
+        return failed
 
-    def _delete_event(self, event, calendar):
+    def _delete_events(self, events, service):
         """
-        Delete the given event from Outlook
+        Delete the given events from Outlook with a single request
+        Return the events which failed & why
         """
-        try:
-            # Get the event from outlook
-            exchange_event = calendar.get_event(id=event.exchange_id)
+        request = ews.delete_items([
+            event.exchange_id
+            for event in events
+        ])
+
+        failed = []
+        for event, message in self._send_batch(service, request, events):
+            if message.code in (ews.NO_ERROR, ews.ITEM_NOT_FOUND):
+                # Event is gone (maybe it already was), that's what we wanted
+                self._mark_pushed(event)
+            else:
+                failed.append((event, message))
+        return failed
+
+    def _delete_old_events(self, events, service):
+        """
+        Delete the given events' own items from Outlook with a single request
+        so they can be pushed as part of a block instead
+        Return the events which failed & why
+        """
+        failed = self._delete_events(events, service)
+        failed_events = set(event for event, message in failed)
+        for event in events:
+            if event not in failed_events:
+                event.exchange_id = None
+                event.updated = True
+        return failed
+
+    def _link_block(self, block, item):
+        """
+        Record that the given block's events are up to date in item
+        """
+        item.event_type = block.event_type
+        item.first_day = block.first_day
+        item.last_day = block.last_day
+        item.last_push = datetime.datetime.now()
+        for event in block.events:
+            event.exchange_item = item
+            self._mark_pushed(event)
+
+    def _create_blocks(self, blocks, service):
+        """
+        Create an item for each of the given blocks in Outlook with a single request
+        Return the blocks which failed & why
+        """
+        request = ews.create_items([
+            self._calendar_item(block)
+            for block in blocks
+        ])
 
-            # Cancel it!
-            exchange_event.cancel()
-        except ExchangeItemNotFoundException:
-            # Event is already gone, ignore it
-            pass
+        failed = []
+        for block, message in self._send_batch(service, request, blocks):
+            if message.code == ews.NO_ERROR:
+                item = self.db.models.ExchangeItem(
+                    user_id=block.events[0].user_id,
+                    exchange_id=message.exchange_id,
+                    event_type=block.event_type,
+                )
+                self.db.session.add(item)
+                self._link_block(block, item)
+            else:
+                failed.append((block, message))
+        return failed
+
+    def _update_blocks(self, blocks, service):
+        """
+        Update each of the given blocks' items in Outlook with a single request
+        Return the blocks which failed & why
+        """
+        request = ews.update_items([
+            (block.item.exchange_id, self._calendar_item(block))
+            for block in blocks
+        ])
+
+        failed = []
+        for block, message in self._send_batch(service, request, blocks):
+            if message.code == ews.NO_ERROR:
+                self._link_block(block, block.item)
+            else:
+                if message.code == ews.ITEM_NOT_FOUND:
+                    # Someone deleted it, create it again next time
+                    self._delete_item(block.item)
+                failed.append((block, message))
+        return failed
+
+    def _delete_item(self, item):
+        """
+        Forget the given item (its events will be pushed again)
+        """
+        for event in list(item.events):
+            event.exchange_item = None
+            if not event.deleted:
+                event.updated = True
+        self.db.session.delete(item)
+
+    def _delete_items(self, items, service):
+        """
+        Delete the given items from Outlook with a single request
+        Return the items which failed & why
+        """
+        request = ews.delete_items([
+            item.exchange_id
+            for item in items
+        ])
+
+        failed = []
+        for item, message in self._send_batch(service, request, items):
+            if message.code in (ews.NO_ERROR, ews.ITEM_NOT_FOUND):
+                self._delete_item(item)
+            else:
+                failed.append((item, message))
+        return failed
+
+    def _get_spans(self, user, items, item_events):
+        """
+        Find the spans of days whose blocks might not match the user's items;
+        days with events waiting to be pushed & items whose events have changed
+        Items next to those spans are included as their blocks may join up
+        Return the spans & the items in them
+        """
+        Event = self.db.models.Event
+        spans = [
+            (event.day, event.day)
+            for event in self.db.session.query(
+                Event.day
+            ).filter(
+                Event.user_id == user.id,
+                Event.deleted == False,
+                Event.period == 'AFD',
+                Event.event_type.in_(COALESCE_TYPES),
+                or_(
+                    Event.updated == True,
+                    Event.exchange_item_id == None,
+                ),
+            )
+        ]
+        for item in items:
+            count, first_day, last_day = item_events.get(item.id, (0, None, None))
+            if (first_day != item.first_day
+                    or last_day != item.last_day
+                    or count != _weekdays(item.first_day, item.last_day)):
+                spans.append((item.first_day, item.last_day))
+
+        span_items = set()
+        while True:
+            spans = _merge_spans(spans)
+            near_items = [
+                item
+                for item in items
+                if item not in span_items and any(
+                    item.first_day - BLOCK_GAP <= last_day and item.last_day + BLOCK_GAP >= first_day
+                    for first_day, last_day in spans
+                )
+            ]
+            if not near_items:
+                return spans, span_items
+            for item in near_items:
+                span_items.add(item)
+                spans.append((item.first_day, item.last_day))
+
+    def _get_blocks(self, user, spans):
+        """
+        Group the user's live all day events in the given spans into blocks of
+        consecutive days (ignoring weekends) with the same type
+        """
+        Event = self.db.models.Event
+        events = self.db.session.query(
+            Event
+        ).filter(
+            Event.user_id == user.id,
+            Event.deleted == False,
+            Event.period == 'AFD',
+            Event.event_type.in_(COALESCE_TYPES),
+            or_(*[
+                and_(Event.day >= first_day, Event.day <= last_day)
+                for first_day, last_day in spans
+            ]),
+        ).order_by(
+            Event.event_type,
+            Event.day,
+        ).all()
+
+        blocks = []
+        for event in events:
+            if blocks:
+                block = blocks[-1]
+                if block.event_type == event.event_type and _consecutive(block.last_day, event.day):
+                    block.events.append(event)
+                    continue
+            blocks.append(Block(event.event_type, [event]))
+        return blocks
+
+    def _push_blocks(self, user, service, result):
+        """
+        Make the user's Exchange items match their blocks of all day events
+        Only days which might have changed are looked at; blocks whose days
+        haven't changed are left alone & the rest reuse an overlapping old
+        item where they can
+        """
+        ExchangeItem = self.db.models.ExchangeItem
+        Event = self.db.models.Event
+        items = self.db.session.query(
+            ExchangeItem
+        ).filter(
+            ExchangeItem.user_id == user.id,
+        ).all()
+
+        # How many live events each item has & the days they cover
+        item_events = dict(
+            (row.exchange_item_id, (row.count, row.first_day, row.last_day))
+            for row in self.db.session.query(
+                Event.exchange_item_id,
+                func.count(Event.id).label('count'),
+                func.min(Event.day).label('first_day'),
+                func.max(Event.day).label('last_day'),
+            ).join(
+                ExchangeItem
+            ).filter(
+                ExchangeItem.user_id == user.id,
+                Event.deleted == False,
+            ).group_by(
+                Event.exchange_item_id
+            )
+        )
+
+        spans, items = self._get_spans(user, items, item_events)
+        if not spans:
+            return
+        blocks = self._get_blocks(user, spans)
+
+        # Find blocks which are already in Exchange just as they are now
+        items_by_days = dict(
+            ((item.event_type, item.first_day, item.last_day), item)
+            for item in items
+        )
+        current_items = set()
+        blocks_to_push = []
+        for block in blocks:
+            item = items_by_days.get((block.event_type, block.first_day, block.last_day))
+            up_to_date = (
+                item is not None
+                and all(
+                    event.exchange_item_id == item.id and not event.updated
+                    for event in block.events
+                )
+                and item_events.get(item.id, (0, ))[0] == len(block.events)
+            )
+            if up_to_date:
+                current_items.add(item)
+            else:
+                blocks_to_push.append(block)
+        old_items = [item for item in items if item not in current_items]
+
+        # Events which still have their own item need that removing first
+        self._push_batches(
+            self._delete_old_events,
+            [
+                event
+                for block in blocks_to_push
+                for event in block.events
+                if event.exchange_id is not None
+            ],
+            service,
+            result,
+            'deleted',
+        )
+        blocks_to_push = [
+            block
+            for block in blocks_to_push
+            if all(event.exchange_id is None for event in block.events)
+        ]
+
+        # Move old items to cover new blocks where they overlap
+        blocks_to_create = []
+        blocks_to_update = []
+        for block in blocks_to_push:
+            overlapping = [
+                item
+                for item in old_items
+                if item.first_day <= block.last_day and item.last_day >= block.first_day
+            ]
+            if overlapping:
+                # Prefer an item of the same type; otherwise its type changes
+                # in place (e.g. a request was approved)
+                overlapping.sort(key=lambda item: item.event_type != block.event_type)
+                block.item = overlapping[0]
+                old_items.remove(block.item)
+                blocks_to_update.append(block)
+            else:
+                blocks_to_create.append(block)
+
+        self._push_batches(
+            self._update_blocks,
+            blocks_to_update,
+            service,
+            result,
+            'updated',
+        )
+        self._push_batches(
+            self._create_blocks,
+            blocks_to_create,
+            service,
+            result,
+            'created',
+        )
+        self._push_batches(
+            self._delete_items,
+            old_items,
+            service,
+            result,
+            'deleted',
+        )
+
+    def _mark_pushed(self, event):
+        """
+        Record that the given event is up to date in Exchange
+        """
+        event.updated = False
+        event.last_push = datetime.datetime.now()
+
+    def _push_batches(self, push, events, service, result, key):
+        """
+        Push the given events to Exchange in batches using push
+        Events which fail are left to be retried next time
+        Update result with what happened
+        """
+        for batch in utils.chunks(events, self.batch_size):
+            failed = push(batch, service)
+            result[key] += len(batch) - len(failed)
+            result['failed'] += len(failed)
+            for event, message in failed:
+                result.setdefault('failures', []).append(
+                    u'{event}: {code} {text}'.format(
+                        event=unicode(event),
+                        code=message.code,
+                        text=message.text or u'',
+                    )
+                )
+
+            # Save exchange ids straight away so they aren't lost if a later
+            # batch fails
+            self.db.session.commit()
 
     def _sync_user(self, user):
         """
         Sync the given user with Exchange
         Return stats about what happened
         """
-        # Get events which have been updated
-        events = self._get_user_updated_events(user)
-
         # Get the Exchange calendar service for this user
-        service = self._get_service(
-            user.exchange_username,
-            user.exchange_password,
-        )
-        calendar = service.calendar()
+        service = self._get_user_service(user)
 
-        # Process the events
         result = {
             'created': 0,
             'updated': 0,
             'skipped': 0,
             'deleted': 0,
+            'failed': 0,
         }
+
+        # Catch up with anything changed in Exchange behind our back
+        self._repair_drift(user, service, result)
+
+        if not self.coalesce:
+            # Split up any blocks from when we were coalescing events
+            self._push_batches(
+                self._delete_items,
+                self.db.session.query(
+                    self.db.models.ExchangeItem
+                ).filter(
+                    self.db.models.ExchangeItem.user_id == user.id,
+                ).all(),
+                service,
+                result,
+                'deleted',
+            )
+
+        # Get events which have been updated
+        events = self._get_user_updated_events(user)
+
+        # Process the events
+        events_to_create = []
+        events_to_update = []
+        events_to_delete = []
         for event in events:
-            if not event.deleted:
+            if event.exchange_item_id is not None and event.deleted:
+                # Its block will be pushed again without it
+                event.exchange_item = None
+                self._mark_pushed(event)
+            elif self.coalesce and not event.deleted and event.period == 'AFD' and event.event_type in COALESCE_TYPES:
+                # This event will be pushed as part of a block
+                pass
+            elif not event.deleted:
                 # This event is waiting to be created/updated
                 if event.exchange_id is None:
-                    # This event has never been created, create it now!
-                    self._create_event(event, calendar)
-                    result['created'] += 1
+                    # This event has never been created, create it soon!
+                    events_to_create.append(event)
                 else:
-                    # This event already exists, update it!
-                    self._update_event(event, calendar)
-                    result['updated'] += 1
+                    # This event already exists, update it soon!
+                    events_to_update.append(event)
             else:
                 # This event is waiting to be deleted
                 if event.exchange_id is None:
                     # This event has never been created, no need to delete it!
+                    self._mark_pushed(event)
                     result['skipped'] += 1
                 else:
-                    # Really delete this event
-                    self._delete_event(event, calendar)
-                    result['deleted'] += 1
-
-            event.updated = False
-            event.last_push = datetime.datetime.now()
+                    # Really delete this event soon
+                    events_to_delete.append(event)
 
         self.db.session.commit()
 
+        # Send the creates, updates & deletes in as few requests as we can
+        self._push_batches(
+            self._create_events,
+            events_to_create,
+            service,
+            result,
+            'created',
+        )
+        self._push_batches(
+            self._update_events,
+            events_to_update,
+            service,
+            result,
+            'updated',
+        )
+        self._push_batches(
+            self._delete_events,
+            events_to_delete,
+            service,
+            result,
+            'deleted',
+        )
+
+        if self.coalesce:
+            self._push_blocks(user, service, result)
+
         return result
 
     @utils.record_runtime
@@ -178,38 +847,93 @@ class Exchange(object):
         Sync the given user with Exchange
         Return stats about what happened
         """
+        # Make sure nobody else is syncing this user at the same time
+        lease = self.leases.acquire(user.id)
+        if lease is None:
+            return {
+                'busy': 'Already being synced elsewhere',
+            }
+
         try:
             # Try to sync the user
             result = self._sync_user(user)
         except Exception, ex:
+            # Throw away anything half done so we can carry on using the session
+            self.db.session.rollback()
             # Save the exception to the user
             result = {
                 'error': str(ex),
             }
+        finally:
+            self.leases.release(user.id, lease)
 
         return result
 
+    def record_sync_user(self, user):
+        """
+        Sync the given user with Exchange & record the status on them
+        Return the username and stats about what happened
+        """
+        # Sync the user
+        result = self.sync_user(user)
+
+        # Record status on the user (whoever is busy syncing them will do it)
+        if 'busy' in result:
+            return user.exchange_username, result
+        user.exchange_last_sync_status = json.dumps(result)
+        user.exchange_last_sync_time = datetime.datetime.now()
+        self.db.session.commit()
+
+        return user.exchange_username, result
+
+    def _sync_worker(self, user_id):
+        """
+        Sync the given user from a worker thread (or return None if they've gone)
+        db.session is scoped per thread so each worker gets its own session;
+        we have to remove it ourselves as there is no request teardown here
+        Services are cached per user so each worker gets its own one too
+        """
+        try:
+            user = self.db.session.query(
+                self.db.models.User
+            ).get(user_id)
+            if user is None:
+                # Deleted since we listed them
+                return None
+            return self.record_sync_user(user)
+        finally:
+            self.db.session.remove()
+
     @utils.record_runtime
-    def sync(self):
+    def sync(self, workers=None):
         """
-        Sync all users events with Exchange
+        Sync all users events with Exchange, using up to #workers users at once
         Return stats about what happened
         """
+        if workers is None:
+            workers = self.workers
+
         users = self.db.session.query(
             self.db.models.User
         ).filter(
             self.db.models.User.sync_enabled == True
         ).all()
-        results = {}
-        for user in users:
-            # Sync the user
-            result = self.sync_user(user)
 
-            # Record status on the user
-            user.exchange_last_sync_status = json.dumps(result)
-            user.exchange_last_sync_time = datetime.datetime.now()
-            self.db.session.commit()
+        if workers > 1:
+            # Workers load their own copy of each user in their own session
+            user_results = utils.parallel_map(
+                self._sync_worker,
+                [user.id for user in users],
+                workers,
+            )
+        else:
+            user_results = [self.record_sync_user(user) for user in users]
 
-            # Record in the full list of results too
-            results[user.exchange_username] = result
+        # Record in the full list of results
+        results = {}
+        for user_result in user_results:
+            if user_result is None:
+                continue
+            username, result = user_result
+            results[username] = result
         return results
@@ -0,0 +1,202 @@
+import datetime
+import json
+import logging
+import threading
+import time
+
+from sqlalchemy import text
+
+
+class JobQueue(object):
+    """
+    Per user Cascade/Exchange syncs kept in the sync_job table so any number
+    of worker processes can share them out
+    NOTE: Postgres (9.5+) only; claiming relies on FOR UPDATE SKIP LOCKED
+    """
+    def __init__(self, db, services, poll=5, stale_after=30 * 60, keep_for=7 * 24 * 60 * 60):
+        self.db = db
+        # direction (e.g. 'cascade') -> service
+        self.services = services
+        self.poll = poll
+        self.stale_after = stale_after
+        self.keep_for = keep_for
+
+    def enqueue(self, direction, user_ids=None, due=None):
+        """
+        Queue a sync in #direction for the given users (or every enabled user)
+        Users who already have a sync queued or running are left alone
+        Return how many jobs were queued
+        """
+        if direction not in self.services:
+            raise Exception('Unknown sync direction {direction}'.format(
+                direction=direction,
+            ))
+
+        User = self.db.models.User
+        if user_ids is None:
+            user_ids = [
+                user.id
+                for user in self.db.session.query(
+                    User.id
+                ).filter(
+                    User.sync_enabled == True
+                )
+            ]
+        if not user_ids:
+            return 0
+
+        # The unique index on outstanding jobs stops us adding duplicates
+        result = self.db.session.execute(text("""
+            INSERT INTO sync_job (user_id, direction, status, due)
+            SELECT id, :direction, 'queued', :due
+            FROM "user"
+            WHERE id IN :user_ids
+            ON CONFLICT DO NOTHING
+        """), {
+            'direction': direction,
+            'due': due or datetime.datetime.now(),
+            'user_ids': tuple(user_ids),
+        })
+        self.db.session.commit()
+        return result.rowcount
+
+    def claim(self):
+        """
+        Mark the next due job as running & return it (or None if nothing is due)
+        Jobs other workers are claiming at the same time are skipped over
+        """
+        row = self.db.session.execute(text("""
+            UPDATE sync_job
+            SET status = 'running', started = :now
+            WHERE id = (
+                SELECT id
+                FROM sync_job
+                WHERE status = 'queued'
+                AND due <= :now
+                ORDER BY due
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, direction
+        """), {
+            'now': datetime.datetime.now(),
+        }).fetchone()
+        self.db.session.commit()
+        return row
+
+    def complete(self, job_id, result):
+        """
+        Record the result of a job
+        """
+        SyncJob = self.db.models.SyncJob
+        self.db.session.query(
+            SyncJob
+        ).filter(
+            SyncJob.id == job_id
+        ).update({
+            'status': 'failed' if 'error' in result else 'done',
+            'finished': datetime.datetime.now(),
+            'result': json.dumps(result),
+        }, synchronize_session=False)
+        self.db.session.commit()
+
+    def tidy(self):
+        """
+        Requeue jobs whose worker seems to have died & remove old finished jobs
+        """
+        SyncJob = self.db.models.SyncJob
+        now = datetime.datetime.now()
+        self.db.session.query(
+            SyncJob
+        ).filter(
+            SyncJob.status == 'running',
+            SyncJob.started < now - datetime.timedelta(seconds=self.stale_after),
+        ).update({
+            'status': 'queued',
+            'started': None,
+        }, synchronize_session=False)
+        self.db.session.query(
+            SyncJob
+        ).filter(
+            SyncJob.status.in_(('done', 'failed')),
+            SyncJob.finished < now - datetime.timedelta(seconds=self.keep_for),
+        ).delete(synchronize_session=False)
+        self.db.session.commit()
+
+    def run_job(self, job):
+        """
+        Sync the user for the given job & record the result
+        Return the result
+        """
+        user = self.db.session.query(
+            self.db.models.User
+        ).get(job.user_id)
+        if user is None or not user.sync_enabled:
+            result = {
+                'error': 'User is not enabled for sync',
+            }
+        else:
+            try:
+                username, result = self.services[job.direction].record_sync_user(user)
+            except Exception, ex:
+                self.db.session.rollback()
+                result = {
+                    'error': str(ex),
+                }
+
+        self.complete(job.id, result)
+        return result
+
+    def _work(self, stop):
+        """
+        Keep claiming & running jobs until stop is set
+        db.session is scoped per thread so each worker gets its own session
+        """
+        while not stop.is_set():
+            try:
+                job = self.claim()
+                if job is None:
+                    stop.wait(self.poll)
+                    continue
+                result = self.run_job(job)
+                logging.info('Synced user {user_id} with {direction}{error}'.format(
+                    user_id=job.user_id,
+                    direction=job.direction,
+                    error=' (Errored!)' if 'error' in result else '',
+                ))
+            except Exception, ex:
+                # Don't let one bad job (or DB blip) kill the worker
+                logging.exception('Sync job failed: {ex}'.format(ex=ex))
+                stop.wait(self.poll)
+            finally:
+                self.db.session.remove()
+
+    def work(self, workers=1, duration=None):
+        """
+        Run jobs with #workers threads for #duration seconds or forever
+        """
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._work, args=(stop, ))
+            for x in xrange(workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        start = time.time()
+        try:
+            while duration is None or time.time() - start < duration:
+                try:
+                    self.tidy()
+                except Exception, ex:
+                    # Don't let a DB blip stop the workers; try again next time
+                    logging.exception('Tidying sync jobs failed: {ex}'.format(ex=ex))
+                    self.db.session.rollback()
+                finally:
+                    self.db.session.remove()
+                stop.wait(min(self.stale_after, duration or self.stale_after))
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
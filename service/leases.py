@@ -0,0 +1,59 @@
+import datetime
+import uuid
+
+from sqlalchemy import text
+
+
+class Leases(object):
+    """
+    Per user leases for one sync direction (e.g. cascade) so only one process
+    syncs a user at a time, kept in the sync_lease table
+    Leases expire after #ttl seconds in case their holder dies; ttl should be
+    longer than the slowest sync
+    """
+    def __init__(self, db, direction, ttl=30 * 60):
+        self.db = db
+        self.direction = direction
+        self.ttl = ttl
+
+    def acquire(self, user_id):
+        """
+        Take the lease for the given user
+        Return a token to release it with or None if someone else has it
+        """
+        now = datetime.datetime.now()
+        token = uuid.uuid4().hex
+        # Only take over an existing lease once it has expired
+        row = self.db.session.execute(text("""
+            INSERT INTO sync_lease (user_id, direction, token, expires)
+            VALUES (:user_id, :direction, :token, :expires)
+            ON CONFLICT (user_id, direction) DO UPDATE
+            SET token = excluded.token, expires = excluded.expires
+            WHERE sync_lease.expires < :now
+            RETURNING token
+        """), {
+            'user_id': user_id,
+            'direction': self.direction,
+            'token': token,
+            'expires': now + datetime.timedelta(seconds=self.ttl),
+            'now': now,
+        }).fetchone()
+        self.db.session.commit()
+
+        if row is None:
+            return None
+        return token
+
+    def release(self, user_id, token):
+        """
+        Give up the lease for the given user (if we still hold it)
+        """
+        SyncLease = self.db.models.SyncLease
+        self.db.session.query(
+            SyncLease
+        ).filter(
+            SyncLease.user_id == user_id,
+            SyncLease.direction == self.direction,
+            SyncLease.token == token,
+        ).delete(synchronize_session=False)
+        self.db.session.commit()
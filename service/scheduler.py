@@ -0,0 +1,194 @@
+import heapq
+import logging
+import random
+import threading
+import time
+
+
+class Scheduler(object):
+    """
+    Keeps syncing users with Cascade & Exchange, each one as it becomes due
+    rather than all of them at once
+    Jobs are kept in a heap of (due time, user id, direction)
+    """
+    def __init__(self, db, services, intervals, workers=1, jitter=0.1,
+                 max_backoff=6 * 60 * 60, refresh=60):
+        self.db = db
+        # direction (e.g. 'cascade') -> service & seconds between syncs
+        self.services = services
+        self.intervals = intervals
+        self.workers = workers
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.refresh = refresh
+
+        # Guards queue & failures, which worker threads share
+        self.lock = threading.Condition()
+        self.queue = []
+        # (user id, direction) -> number of syncs in a row which errored
+        # (kept while a sync runs so refresh doesn't schedule it again)
+        self.failures = {}
+
+    def _delay(self, direction, failures):
+        """
+        Get how long to wait before the next sync, backing off exponentially
+        after errors & adding some jitter so users don't all line up
+        """
+        interval = self.intervals[direction]
+        delay = min(interval * 2 ** failures, max(interval, self.max_backoff))
+        return delay + random.uniform(0, interval * self.jitter)
+
+    def _schedule(self, user_id, direction, failures, last_time=None):
+        """
+        Add a sync to the queue, due #delay after last_time (or now)
+        """
+        self.failures[(user_id, direction)] = failures
+        if last_time is None:
+            last_time = time.time()
+        due = last_time + self._delay(direction, failures)
+        heapq.heappush(self.queue, (due, user_id, direction))
+
+    def _refresh_users(self):
+        """
+        Add any enabled users who aren't scheduled yet, due based on when
+        they were last synced (& whether that errored)
+        """
+        User = self.db.models.User
+        users = self.db.session.query(
+            User
+        ).filter(
+            User.sync_enabled == True
+        ).all()
+
+        with self.lock:
+            self._add_users(users)
+            self.lock.notify_all()
+
+        self.db.session.remove()
+
+    def _add_users(self, users):
+        """
+        Schedule any of the given users who aren't scheduled (or running) yet
+        (must hold self.lock)
+        """
+        for user in users:
+            for direction in self.services:
+                if (user.id, direction) in self.failures:
+                    continue
+
+                last_time = getattr(user, direction + '_last_sync_time')
+                if last_time is None:
+                    # Never synced, spread them over the first interval
+                    due = time.time() + random.uniform(0, self.intervals[direction])
+                    self.failures[(user.id, direction)] = 0
+                    heapq.heappush(self.queue, (due, user.id, direction))
+                else:
+                    errored = getattr(user, direction + '_last_sync_error')
+                    self._schedule(
+                        user.id,
+                        direction,
+                        1 if errored else 0,
+                        time.mktime(last_time.timetuple()),
+                    )
+
+    def _run_job(self, job):
+        """
+        Sync a user from a worker thread
+        Return the result or None if the user shouldn't be synced any more
+        """
+        due, user_id, direction = job
+        try:
+            user = self.db.session.query(
+                self.db.models.User
+            ).get(user_id)
+            if user is None or not user.sync_enabled:
+                return None
+            username, result = self.services[direction].record_sync_user(user)
+            logging.info('Synced {username} with {direction}{error}'.format(
+                username=username,
+                direction=direction,
+                error=' (Errored!)' if 'error' in result else '',
+            ))
+            return result
+        except Exception, ex:
+            # Don't let one bad sync (or DB blip) kill the worker; back off instead
+            logging.exception('Syncing user {user_id} with {direction} failed: {ex}'.format(
+                user_id=user_id,
+                direction=direction,
+                ex=ex,
+            ))
+            return {
+                'error': str(ex),
+            }
+        finally:
+            self.db.session.remove()
+
+    def _finish_job(self, job, result):
+        """
+        Schedule the next sync after a job (must hold self.lock)
+        """
+        due, user_id, direction = job
+        if result is None:
+            # Disabled or deleted; refresh will pick them up again if needed
+            del self.failures[(user_id, direction)]
+            return
+        if 'error' in result:
+            failures = self.failures[(user_id, direction)] + 1
+        else:
+            failures = 0
+        self._schedule(user_id, direction, failures)
+        self.lock.notify()
+
+    def _work(self, stop):
+        """
+        Keep taking the next due job & running it until stop is set
+        Each worker takes a new job as soon as it's done, so one slow user
+        doesn't hold up the others
+        """
+        while not stop.is_set():
+            with self.lock:
+                now = time.time()
+                if not self.queue or self.queue[0][0] > now:
+                    # Nothing due; wait until the next job (or something changes)
+                    wake = self.queue[0][0] - now if self.queue else self.refresh
+                    self.lock.wait(min(wake, self.refresh))
+                    continue
+                job = heapq.heappop(self.queue)
+
+            result = self._run_job(job)
+
+            with self.lock:
+                self._finish_job(job, result)
+
+    def run(self, duration=None):
+        """
+        Keep syncing users as they become due with #workers threads, for
+        #duration seconds or forever
+        """
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=self._work, args=(stop, ))
+            for x in xrange(self.workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        start = time.time()
+        try:
+            while duration is None or time.time() - start < duration:
+                try:
+                    self._refresh_users()
+                except Exception, ex:
+                    logging.exception('Refreshing users failed: {ex}'.format(ex=ex))
+                    self.db.session.remove()
+                wake = self.refresh
+                if duration is not None:
+                    wake = min(wake, start + duration - time.time())
+                stop.wait(max(wake, 0))
+        finally:
+            stop.set()
+            with self.lock:
+                self.lock.notify_all()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,20 @@
+from gunicorn.app.base import BaseApplication
+
+
+class Server(BaseApplication):
+    """
+    Serve a WSGI app with gunicorn; pre-forked worker processes, each with
+    a pool of threads
+    options are gunicorn settings (e.g. bind, workers, threads)
+    """
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super(Server, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.iteritems():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
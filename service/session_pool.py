@@ -0,0 +1,89 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from service import utils
+
+
+class SessionPool(object):
+    """
+    Logged in requests sessions for a single site, one per key (e.g. user)
+    Every session shares the same keep-alive connection pool so we only pay
+    for a TLS handshake per pooled connection rather than per session
+    """
+    def __init__(self, base_url, connections=4, idle_timeout=300, check_after=60, max_size=512):
+        self.base_url = base_url
+        self.check_after = check_after
+        self.adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=connections,
+        )
+        # Sessions are re-cached each time they're used so the ttl is idle time
+        self.sessions = utils.Cache(max_size=max_size, ttl=idle_timeout)
+        self.lock = threading.Lock()
+        self.checks = 0
+        self.failed_checks = 0
+
+    def ensure_connections(self, connections):
+        """
+        Make sure at least #connections connections are kept for reuse
+        (e.g. when more requests are going to be made at once than we expected)
+        Sessions already made share the new connections too
+        """
+        with self.lock:
+            if connections <= self.adapter._pool_maxsize:
+                return
+            old_pool = self.adapter.poolmanager
+            self.adapter.init_poolmanager(1, connections)
+        # Requests still using the old connections close them when they finish
+        old_pool.clear()
+
+    def new_session(self):
+        """
+        Make a new (not logged in) session which uses the shared connections
+        NOTE: Don't close these; that would close the shared connections too
+        """
+        session = requests.Session()
+        session.mount(self.base_url, self.adapter)
+        return session
+
+    def get(self, key, create, check):
+        """
+        Get the session for key, calling create() to make one if there isn't
+        a usable one in the pool
+        Sessions which have been idle for more than check_after seconds are
+        only reused if check(session) says they're still logged in
+        """
+        now = time.time()
+        entry = self.sessions.get(key)
+        session = None
+        if entry is not None:
+            session, last_used = entry
+            if now - last_used > self.check_after:
+                with self.lock:
+                    self.checks += 1
+                if not check(session):
+                    with self.lock:
+                        self.failed_checks += 1
+                    session = None
+
+        if session is None:
+            session = create()
+
+        self.sessions.set(key, (session, now))
+        return session
+
+    def discard(self, key):
+        """
+        Remove the session for key from the pool
+        """
+        self.sessions.delete(key)
+
+    @property
+    def stats(self):
+        stats = self.sessions.stats
+        stats['checks'] = self.checks
+        stats['failed_checks'] = self.failed_checks
+        return stats
@@ -1,11 +1,116 @@
+from collections import OrderedDict
 import calendar
 import datetime
 import functools
+import hashlib
+import hmac
+import os
+import Queue
+import sys
+import threading
+import time
 
-from memoize import Memoizer
 
-store = {}
-memo = Memoizer(store)
+# Salt for credential fingerprints; only needs to last as long as the process
+CREDENTIAL_SALT = os.urandom(16)
+
+
+def credential_key(identity, *credentials):
+    """
+    Get a cache key for the given identity (e.g. a user id) & credentials
+    Credentials are only kept as a salted hash so they can't leak from a cache
+    """
+    fingerprint = hmac.new(
+        CREDENTIAL_SALT,
+        u'\0'.join(credentials).encode('utf8'),
+        hashlib.sha256,
+    ).hexdigest()
+    return (identity, fingerprint)
+
+
+class Cache(object):
+    """
+    Thread safe cache which holds at most max_size entries for at most ttl
+    seconds each, evicting the least recently used entries when full
+    """
+    def __init__(self, max_size=256, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """
+        Get the value for key if it's cached & still fresh
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires, value = entry
+            if expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            # Move this entry to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache value for key, evicting old entries if we're full
+        """
+        if ttl is None:
+            ttl = self.ttl
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove key from the cache (if it's there)
+        """
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_or_create(self, key, create, ttl=None):
+        """
+        Get the value for key, calling create() to make it if it isn't cached
+        NOTE: create is called without the lock held so may run more than once
+        for the same key at the same time
+        """
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            value = create()
+            self.set(key, value, ttl=ttl)
+        return value
+
+    @property
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
 
 
 def next_month(year, month):
@@ -28,6 +133,17 @@ def add_months(year, month, months):
     return year, month
 
 
+def chunks(items, size):
+    """
+    Split items into lists of at most size items
+    """
+    size = max(size, 1)
+    return [
+        items[i:i+size]
+        for i in xrange(0, len(items), size)
+    ]
+
+
 def record_runtime(func):
     @functools.wraps(func)
     def inner(*args, **kwargs):
@@ -39,65 +155,143 @@ def record_runtime(func):
     return inner
 
 
+def parallel_map(func, items, workers):
+    """
+    Call func on each of items using a pool of at most #workers threads
+    Return the results in the same order as items
+    If any call raises, no more items are started & the first error is raised
+    NOTE: func must not share DB sessions/objects between threads
+    """
+    items = list(items)
+    workers = min(workers, len(items))
+    if workers <= 1:
+        # Not worth starting any threads
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    todo = Queue.Queue()
+    for index, item in enumerate(items):
+        todo.put((index, item))
+
+    def work():
+        while not errors:
+            try:
+                index, item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(item)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    threads = [
+        threading.Thread(target=work)
+        for x in xrange(workers)
+    ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        # Re-raise with the original traceback
+        error_type, error, traceback = errors[0]
+        raise error_type, error, traceback
+
+    return results
+
+
+class CalendarCell(object):
+    """
+    A single cell in a calendar month
+    """
+    __slots__ = ('klass', 'text', 'caption', 'today')
+
+    def __init__(self, klass='calendar_cell_blank', text='', caption='', today=False):
+        self.klass = klass
+        self.text = text
+        self.caption = caption
+        self.today = today
+
+    def copy(self):
+        return CalendarCell(self.klass, self.text, self.caption, self.today)
+
+
+# Blank months for generate_calendar, keyed on (year, month); never modify these!
+MONTH_SKELETONS = {}
+
+
+def get_month_skeleton(year, month):
+    """
+    Get the (shared) blank calendar for the given month
+    Return the header, the number of blank cells before the 1st & 42 cells
+    (6 weeks) with every day marked as upcoming
+    """
+    key = (year, month)
+    skeleton = MONTH_SKELETONS.get(key)
+    if skeleton is None:
+        first_weekday, month_length = calendar.monthrange(year, month)
+        if first_weekday < 2:
+            # It looks weird if anything starts on the first few days...
+            first_weekday += 7
+
+        cells = [CalendarCell() for x in xrange(42)]
+        for i in xrange(month_length):
+            day = datetime.date(year=year, month=month, day=i + 1)
+            cells[i + first_weekday] = CalendarCell(
+                klass='calendar_cell_empty',
+                text=i + 1,
+                caption=day.strftime('%a, %b %d'),
+            )
+
+        header = datetime.date(year=year, month=month, day=1).strftime('%b %Y')
+        skeleton = (header, first_weekday, tuple(cells))
+        MONTH_SKELETONS[key] = skeleton
+    return skeleton
+
+
 def generate_calendar(db, user, start_year, start_month, months):
     """
     Generate a data structure to allow a calendar style output
     """
+    Event = db.models.Event
+
     # Get the period we want to show events for
-    year = start_year
-    month = start_month
-    months = 6
-    months_start = datetime.date(year=year, month=month, day=1)
-    year, month = add_months(year, month, months)
+    months_start = datetime.date(year=start_year, month=start_month, day=1)
+    year, month = add_months(start_year, start_month, months)
     months_end = datetime.date(year=year, month=month, day=1)
 
     events = db.session.query(
-        db.models.Event
+        Event.day,
+        Event.period,
+        Event.event_type,
     ).filter(
-        db.models.Event.user == user,
-        db.models.Event.deleted == False,
-        db.models.Event.day >= months_start,
-        db.models.Event.day < months_end,
-        db.models.Event.deleted == False,
+        Event.user_id == user.id,
+        Event.deleted == False,
+        Event.day >= months_start,
+        Event.day < months_end,
     )
 
-
-    # Construct the calendar
+    # Construct the calendar from copies of the blank months
     year = start_year
     month = start_month
     today = datetime.date.today()
-    class Day(object):
-        klass = 'calendar_cell_blank'
-        text = ''
-        caption = ''
-        today = False
     event_calendar = []
     for x in xrange(months):
-        # Generate 6 weeks of cells
-        cells = [Day() for x in xrange(42)]
+        header, first_weekday, skeleton_cells = get_month_skeleton(year, month)
+        cells = [cell.copy() for cell in skeleton_cells]
 
-        # Get the days from calendar
-        #monthrange
-        first_weekday, month_length = calendar.monthrange(year, month)
-        if first_weekday < 2:
-            # It looks weird if anything starts on the first few days...
-            first_weekday += 7
-        for i in xrange(month_length):
-            day_number = i + 1
-            cell_index = i + first_weekday
-            day = datetime.date(year=year, month=month, day=day_number)
-            if day == today:
-                cells[cell_index].today = True
-            if day < today:
-                cells[cell_index].klass = 'calendar_cell_old'
+        # Mark days which have already gone
+        if (year, month) <= (today.year, today.month):
+            if (year, month) == (today.year, today.month):
+                old_days = today.day - 1
+                cells[old_days + first_weekday].today = True
             else:
-                cells[cell_index].klass = 'calendar_cell_empty'
-            cells[cell_index].text = day_number
-            cells[cell_index].caption = day.strftime('%a, %b %d')
-
-        # Get the row header
-        first_day = datetime.date(year=year, month=month, day=1)
-        header = first_day.strftime('%b %Y')
+                old_days = calendar.monthrange(year, month)[1]
+            for cell in cells[first_weekday:first_weekday + old_days]:
+                cell.klass = 'calendar_cell_old'
 
         # Add this row to the list
         event_calendar.append({
@@ -109,23 +303,17 @@ def generate_calendar(db, user, start_year, start_month, months):
         # Move to the next month
         year, month = next_month(year, month)
 
-
     # Apply events to the calendar
-    for event in events:
-        # Work out the month for this event
-        event_month = event.day.month - start_month
-        if event_month < 0:
-            # This is next year
-            event_month += 12
-
-        # Work out the day for this event
-        event_day = event.day.day + event_calendar[event_month]['days_pre'] - 1
+    for day, period, event_type in events:
+        # Work out the month & cell for this event
+        event_month = (day.year - start_year) * 12 + day.month - start_month
+        event_day = day.day + event_calendar[event_month]['days_pre'] - 1
 
         # Update the calendar
         calendar_cell = event_calendar[event_month]['cells'][event_day]
-        calendar_cell.klass = 'calendar_cell_{0}'.format(event.event_type)
-        if event.period != 'AFD':
-            calendar_cell.text = event.period
+        calendar_cell.klass = 'calendar_cell_{0}'.format(event_type)
+        if period != 'AFD':
+            calendar_cell.text = period
 
     # All done!
     return event_calendar